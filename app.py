@@ -1,32 +1,65 @@
 import streamlit as st
-import os
-import shutil
-import json
-from groq import Groq
 
 # --- IMPORT YOUR BACKEND SCRIPTS ---
 # We import specific functions from your existing files
-from ingest import load_and_structure_file
-from chunking import create_semantic_chunks
-from index import index_data
-from retrieve import search_and_rerank
+from jobs import JobQueue
+from retrieve import search_and_rerank, get_retriever
+from generate import stream_answer, cached_answer, remember_answer, answer_cache_stats
+from corpus import CorpusRegistry
+from tracing import Trace, trace, export_json, prometheus_text, start_metrics_server
 
-# --- CONFIGURATION ---
-# IMPORTANT: Put your Groq API Key here or use os.environ
-API_KEY = os.getenv("GROQ_API_KEY") 
-MODEL_NAME = "llama-3.3-70b-versatile"
-from dotenv import load_dotenv
+# LLM connection settings live in llm.py (GROQ_API_KEY from .env), model and prompt in generate.py
 
-load_dotenv()
+# --- CONFIGURATION ---
+METRICS_PORT = None # e.g. 9100: serve /metrics (Prometheus) and /traces (JSON) next to the app
+# ---------------------
 
 # Setup Page
 st.set_page_config(page_title="RAG Knowledge Base", layout="wide")
 
+@st.cache_resource(show_spinner="🔥 Loading retrieval models...")
+def load_retriever():
+    # Runs once per server process, so the first question doesn't pay the cold start
+    return get_retriever().warm_up()
+
+retriever = load_retriever()
+
+@st.cache_resource
+def load_job_queue():
+    # Shared by every session: ingestion runs in worker processes, indexing
+    # reuses the retriever's client so chat keeps working meanwhile.
+    return JobQueue(
+        client=retriever.client,
+        embedders=(retriever.embedder, retriever.sparse_embedder),
+        client_lock=retriever.client_lock,
+        on_indexed=retriever.invalidate_stale_scores,
+    )
+
+job_queue = load_job_queue()
+
+@st.cache_resource
+def load_metrics_server():
+    # One server per process, however many sessions are open
+    return start_metrics_server(METRICS_PORT) if METRICS_PORT else None
+
+load_metrics_server()
+
+def show_timings(chat_trace):
+    # Where this answer's time went, stage by stage
+    if not isinstance(chat_trace, Trace): # Tracing disabled
+        return
+    with st.expander("🧭 Timings", expanded=False):
+        st.dataframe(
+            [{"stage": s["name"], "start (ms)": s["start_ms"], "duration (ms)": s["duration_ms"]}
+             for s in chat_trace.spans],
+            hide_index=True,
+        )
+
 # Session State Initialization
 if "messages" not in st.session_state:
     st.session_state.messages = []
-if "processed_file" not in st.session_state:
-    st.session_state.processed_file = None
+if "submitted_files" not in st.session_state:
+    st.session_state.submitted_files = set()
 
 # --- SIDEBAR: FILE UPLOAD & PROCESSING ---
 with st.sidebar:
@@ -35,47 +68,45 @@ with st.sidebar:
     
     uploaded_file = st.file_uploader("Upload Document", type=["pdf", "txt", "docx", "png", "jpg", "jpeg"])
     
-    if uploaded_file and uploaded_file.name != st.session_state.processed_file:
-        with st.spinner("🚀 Processing file... (Ingesting -> Chunking -> Indexing)"):
-            
-            # 1. SAVE FILE LOCALLY
-            # Streamlit keeps files in RAM, we must save it to disk for ingest.py to read
-            save_path = uploaded_file.name
-            with open(save_path, "wb") as f:
-                f.write(uploaded_file.getbuffer())
-            
-            st.info(f"File saved: {save_path}")
-
-            # 2. RUN INGESTION (Step 1)
-            # We call your function directly!
-            try:
-                raw_blocks = load_and_structure_file(save_path)
-                # Save to JSON for the next step (mimicking your pipeline)
-                with open("raw_data.json", "w", encoding="utf-8") as f:
-                    json.dump(raw_blocks, f, indent=2, ensure_ascii=False)
-                st.success(f"Ingestion complete: {len(raw_blocks)} raw blocks extracted.")
-                
-                # 3. RUN CHUNKING (Step 2)
-                semantic_chunks = create_semantic_chunks(raw_blocks)
-                with open("semantic_chunks.json", "w", encoding="utf-8") as f:
-                    json.dump(semantic_chunks, f, indent=2, ensure_ascii=False)
-                st.success(f"Chunking complete: {len(semantic_chunks)} semantic chunks created.")
-
-                # 4. RUN INDEXING (Step 3)
-                # We need to ensure index.py reads the correct file
-                # Since index.py reads 'semantic_chunks.json' by default, we are good.
-                index_data() 
-                st.success("Indexing complete: Data stored in Qdrant!")
-                
-                # Mark as done
-                st.session_state.processed_file = uploaded_file.name
-                st.balloons()
-                
-            except Exception as e:
-                st.error(f"Error during processing: {e}")
+    if uploaded_file:
+        upload_key = (uploaded_file.name, uploaded_file.size)
+        if upload_key not in st.session_state.submitted_files:
+            # Hand the bytes to the background queue; the UI stays responsive
+            job_queue.submit(uploaded_file.name, uploaded_file.getvalue())
+            st.session_state.submitted_files.add(upload_key)
+            st.info(f"Queued '{uploaded_file.name}' for processing (Ingesting -> Chunking -> Indexing).")
+
+    @st.fragment(run_every=2)
+    def show_jobs():
+        # Refreshes on its own every 2s without rerunning the chat
+        for job in job_queue.jobs()[:5]:
+            if job["stage"] == "done":
+                report = job["report"]
+                st.success(f"✅ {job['file']}: {report['added']} added, {report['updated']} updated, "
+                           f"{report['removed']} removed, {report['refreshed']} refreshed, {report['unchanged']} unchanged.")
+            elif job["stage"] == "failed":
+                st.error(f"❌ {job['file']}: {job['error']}")
+            elif job["stage"] == "indexing":
+                st.info(f"🧠 {job['file']}: indexing {job['indexed']}/{job['chunks']} chunks...")
+            else:
+                st.info(f"🚀 {job['file']}: {job['stage']} ({job['chunks']} chunks so far)...")
+
+    show_jobs()
 
     st.markdown("---")
-    st.markdown("**Status:** " + ("✅ Ready" if st.session_state.processed_file else "⚠️ Waiting for file"))
+    registry = CorpusRegistry()
+    st.markdown("**Status:** " + ("✅ Ready" if registry.sources() else "⚠️ Waiting for file"))
+    cache_stats = answer_cache_stats()
+    st.caption(f"💾 Answer cache: {cache_stats['size']} answers, {cache_stats['hit_rate']:.0%} hit rate")
+    with st.expander("📈 Metrics"):
+        st.download_button("Recent traces (JSON)", export_json(), file_name="traces.json", mime="application/json")
+        st.download_button("Stage metrics (Prometheus)", prometheus_text(), file_name="metrics.txt",
+                           mime="text/plain")
+
+    # Search scope: Qdrant filters by these before anything is reranked
+    selected_sources = st.multiselect("Search in documents", registry.sources(), help="Empty = all documents")
+    selected_subjects = st.multiselect("Limit to subjects", registry.subjects(selected_sources))
+    search_filters = {"source": selected_sources, "subject_context": selected_subjects}
 
 # --- MAIN CHAT INTERFACE ---
 st.title("🤖 Chat with your Documents")
@@ -94,74 +125,53 @@ if prompt := st.chat_input("Ask a question about your document..."):
     st.session_state.messages.append({"role": "user", "content": prompt})
 
     # 2. Assistant Logic
-    with st.chat_message("assistant"):
+    with st.chat_message("assistant"), trace("chat", query=prompt) as chat_trace:
         message_placeholder = st.empty()
         
-        with st.spinner("Thinking..."):
-            try:
+        try:
+            with st.spinner("Searching..."):
                 # A. RETRIEVAL (Step 4)
-                # We call search_and_rerank directly to get the chunks
-                retrieved_chunks = search_and_rerank(prompt)
-                
-                # B. DISPLAY CHUNKS (Your Requirement)
-                # We put this in an expander so it looks clean
-                with st.expander("🔍 Verified Sources (Top 5 Chunks)", expanded=False):
-                    if not retrieved_chunks:
-                        st.warning("No relevant information found.")
-                    else:
-                        for i, chunk in enumerate(retrieved_chunks):
-                            st.markdown(f"**Rank {i+1} (Score: {chunk['score']:.4f})**")
-                            st.info(f"📄 *Page {chunk['meta'].get('page', '?')}*: {chunk['text']}")
-                            st.markdown("---")
-
-                # C. GENERATION (Step 5)
-                # We construct the prompt here to ensure we use the chunks we just displayed
+                # A close enough earlier question reuses its answer and sources;
+                # otherwise we call search_and_rerank directly to get the chunks
+                hit, cache_key = cached_answer(prompt, filters=search_filters)
+                retrieved_chunks = hit["chunks"] if hit else search_and_rerank(prompt, filters=search_filters)
+            
+            # B. DISPLAY CHUNKS (Your Requirement)
+            # We put this in an expander so it looks clean
+            with st.expander("🔍 Verified Sources (Top 5 Chunks)", expanded=False):
                 if not retrieved_chunks:
-                     response_text = "I couldn't find any relevant information in the documents to answer your question."
+                    st.warning("No relevant information found.")
                 else:
-                    context_text = ""
                     for i, chunk in enumerate(retrieved_chunks):
-                        context_text += f"\n[Source {i+1}]: {chunk['text']}"
-                    
-                    system_prompt = f"""
-    You are a careful and factual assistant.
-    
-    Your task is to answer the user's question using ONLY the provided context.
-    
-    CRITICAL INSTRUCTION:
-    Before answering, you must THINK STEP BY STEP to analyze the context.
-    
-    Follow these rules strictly:
-    
-    1. Use ONLY the information present in the context.
-    2. If the answer is not explicitly stated in the context, respond with:
-       "I don't know based on the provided documents."
-       This rule has the highest priority.
-    3. Do NOT use outside knowledge or assumptions.
-    4. Do NOT rephrase facts in a misleading way.
-    5. Cite the source number (e.g., [Source 1]) after each factual statement.
-    6. Keep the answer concise, precise, and professional.
-
-    Context:
-    {context_text}
-    """
-                    # Call Groq
-                    client = Groq(api_key=API_KEY)
-                    chat_completion = client.chat.completions.create(
-                        messages=[
-                            {"role": "system", "content": system_prompt},
-                            {"role": "user", "content": prompt}
-                        ],
-                        model=MODEL_NAME,
-                        temperature=0.0,
-                    )
-                    response_text = chat_completion.choices[0].message.content
+                        st.markdown(f"**Rank {i+1} (Score: {chunk['score']:.4f})**")
+                        st.info(f"📄 *Page {chunk['meta'].get('page', '?')}*: {chunk['text']}")
+                        st.markdown("---")
+
+            # C. GENERATION (Step 5)
+            # Uses the chunks we just displayed; tokens are rendered as they arrive
+            if hit:
+                response_text = hit["answer"]
+                message_placeholder.markdown(response_text)
+                st.caption(f"💾 Cached answer to a similar question ({hit['similarity']:.2f}): '{hit['query']}'")
+            elif not retrieved_chunks:
+                 response_text = "I couldn't find any relevant information in the documents to answer your question."
+                 message_placeholder.markdown(response_text)
+            else:
+                response_text = ""
+                stats = {}
+                for text in stream_answer(prompt, retrieved_chunks, stats=stats):
+                    response_text += text
+                    message_placeholder.markdown(response_text + "▌")
 
                 # D. Display Output
                 message_placeholder.markdown(response_text)
-                
-                # Save to history
-                st.session_state.messages.append({"role": "assistant", "content": response_text})
+                st.caption(f"⏱️ First token {stats['ttft_ms']:.0f} ms · {stats['tokens_per_s']:.0f} tokens/s · "
+                           f"{stats['context']['tokens_saved']} context tokens saved")
+                remember_answer(cache_key, prompt, response_text, retrieved_chunks)
+            show_timings(chat_trace)
+            
+            # Save to history
+            st.session_state.messages.append({"role": "assistant", "content": response_text})
 
-            except Exception as e:
-                st.error(f"An error occurred: {e}")
\ No newline at end of file
+        except Exception as e:
+            st.error(f"An error occurred: {e}")
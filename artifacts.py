@@ -0,0 +1,25 @@
+import json
+
+def write_jsonl(records, path):
+    """
+    Passes records through unchanged while appending each one to a JSON Lines
+    file, so a pipeline stage can be saved without collecting it in memory.
+    """
+    with open(path, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")))
+            f.write("\n")
+            yield record
+
+def read_records(path):
+    """
+    Streams records from a .jsonl file, or loads a classic .json list.
+    """
+    if path.endswith(".jsonl"):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            yield from json.load(f)
@@ -0,0 +1,399 @@
+import argparse
+import json
+import os
+import statistics
+import threading
+import time
+
+# --- CONFIGURATION ---
+SAMPLE_QUERIES = [
+    "What is the detailed syllabus for the hardware workshop?",
+    "Which topics are covered in the hardware workshop course?",
+    "List the units taught in the hardware workshop subject.",
+    "Hardware workshop course outline and teaching hours",
+    "What are the course outcomes of Programming for Problem Solving?",
+    "Which textbooks are recommended for the C programming course?",
+    "How many teaching hours does the fundamentals of C module have?",
+    "What are the new job roles mentioned in the report?",
+]
+CHUNKS_FILE = "semantic_chunks.json"
+RAW_BLOCKS_FILE = "raw_data.json"
+# ---------------------
+
+def _median_ms(fn, repeat):
+    """
+    Runs fn `repeat` times and returns the median wall time in milliseconds.
+    """
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+def _bench_retriever():
+    """
+    The process-wide Retriever, warmed up, with the persistent score cache
+    off: cached scores would turn every rerank after the first into
+    lookups, and benchmark pairs don't belong in rerank_cache.json.
+    """
+    from retrieve import get_retriever
+
+    retriever = get_retriever()
+    retriever.score_cache = None
+    return retriever.warm_up()
+
+def bench_search(args):
+    """
+    Latency of embedding + hybrid search against the number of query
+    variations: one embed/search per variation vs. one batched pass.
+    """
+    retriever = _bench_retriever()
+
+    print(f"\n📊 Search latency vs. variations (median of {args.repeat} runs)")
+    print(f"{'variations':>10} | {'sequential ms':>13} | {'batched ms':>10} | {'speedup':>7}")
+    print("-" * 50)
+
+    for n in range(1, args.max_variations + 1):
+        queries = SAMPLE_QUERIES[:n]
+
+        def sequential():
+            for q in queries:
+                dense, sparse = retriever._embed_queries([q])[0]
+                retriever._search(dense, sparse)
+
+        def batched():
+            retriever._search_batch(retriever._embed_queries(queries))
+
+        seq_ms = _median_ms(sequential, args.repeat)
+        batch_ms = _median_ms(batched, args.repeat)
+        print(f"{n:>10} | {seq_ms:>13.1f} | {batch_ms:>10.1f} | {seq_ms / batch_ms:>6.2f}x")
+
+def bench_backends(args):
+    """
+    Search latency of the in-process local index vs. Qdrant on the same
+    query embeddings, and how much of Qdrant's top-k it returns.
+    """
+    from retrieve import SEARCH_LIMIT
+
+    # One Retriever: local Qdrant allows a single client per folder
+    retriever = _bench_retriever()
+    index = retriever._local_index(retriever.collection_name)
+    queries = SAMPLE_QUERIES[:args.variations]
+    embedded = retriever._embed_queries(queries)
+    dense = [vector for vector, _ in embedded]
+
+    qdrant_ms = _median_ms(lambda: retriever._search_batch(embedded, SEARCH_LIMIT), args.repeat)
+    local_ms = _median_ms(lambda: index.search_batch(queries, dense, None, SEARCH_LIMIT), args.repeat)
+    end_to_end = {}
+    for backend in ("qdrant", "local"):
+        retriever.search_backend = backend
+        end_to_end[backend] = _median_ms(lambda: retriever.search_variations(queries), args.repeat)
+
+    qdrant_hits = retriever._search_batch(embedded, SEARCH_LIMIT)
+    local_hits = index.search_batch(queries, dense, None, SEARCH_LIMIT)
+    overlap = statistics.mean(
+        len({h.id for h in a[:args.k]} & {h.id for h in b[:args.k]}) / max(1, min(args.k, len(a)))
+        for a, b in zip(qdrant_hits, local_hits)
+    )
+
+    print(f"\n📊 Qdrant vs. local index: {len(index.ids)} chunks ({index.dtype}), {len(queries)} variations, "
+          f"median of {args.repeat} runs")
+    print(f"{'backend':>8} | {'search ms':>9} | {'embed + search ms':>17}")
+    print("-" * 42)
+    print(f"{'qdrant':>8} | {qdrant_ms:>9.2f} | {end_to_end['qdrant']:>17.2f}")
+    print(f"{'local':>8} | {local_ms:>9.2f} | {end_to_end['local']:>17.2f}")
+    print(f"   Local returns {overlap:.0%} of Qdrant's top-{args.k} (BM25 stands in for the sparse model)")
+
+def bench_fusion(args):
+    """
+    How much CrossEncoder work pruning saves, and how much of the unpruned
+    top-k it keeps (recall@k against reranking every fused candidate).
+    """
+    from retrieve import generate_query_variations, TOP_K
+
+    retriever = _bench_retriever()
+
+    results = {n: {"pairs": 0, "recall": [], "ms": 0.0} for n in args.candidates}
+    full_pairs = 0
+    full_ms = 0.0
+
+    for query in SAMPLE_QUERIES:
+        fused = retriever.retrieve_candidates(generate_query_variations(query))
+        hits = [hit for _, hit in fused]
+
+        start = time.perf_counter()
+        reference = [hit.id for _, hit in retriever.rerank(query, hits)[:TOP_K]]
+        full_ms += (time.perf_counter() - start) * 1000
+        full_pairs += len(hits)
+        if not reference:
+            continue
+
+        for n in args.candidates:
+            start = time.perf_counter()
+            pruned = [hit.id for _, hit in retriever.rerank(query, hits[:n])[:TOP_K]]
+            results[n]["ms"] += (time.perf_counter() - start) * 1000
+            results[n]["pairs"] += min(n, len(hits))
+            results[n]["recall"].append(len(set(pruned) & set(reference)) / len(reference))
+
+    print(f"\n📊 Fusion pruning ({retriever.fusion_method}) over {len(SAMPLE_QUERIES)} queries")
+    print(f"   Unpruned: {full_pairs} pairs, {full_ms:.0f} ms rerank")
+    print(f"{'top-N':>6} | {'pairs':>6} | {'reduction':>9} | {'rerank ms':>9} | recall@{TOP_K}")
+    print("-" * 52)
+    for n in args.candidates:
+        r = results[n]
+        reduction = full_pairs / r["pairs"] if r["pairs"] else 0.0
+        recall = statistics.mean(r["recall"]) if r["recall"] else 0.0
+        print(f"{n:>6} | {r['pairs']:>6} | {reduction:>8.1f}x | {r['ms']:>9.0f} | {recall:.3f}")
+
+def _ranks(values):
+    order = sorted(range(len(values)), key=lambda i: values[i])
+    ranks = [0] * len(values)
+    for rank, i in enumerate(order):
+        ranks[i] = rank
+    return ranks
+
+def _spearman(a, b):
+    """
+    Spearman rank correlation (ties broken by position; fine for float scores).
+    """
+    n = len(a)
+    if n < 2:
+        return 1.0
+    ra, rb = _ranks(a), _ranks(b)
+    d2 = sum((x - y) ** 2 for x, y in zip(ra, rb))
+    return 1 - 6 * d2 / (n * (n * n - 1))
+
+def _top_overlap(a, b, k):
+    top = lambda scores: set(sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)[:k])
+    return len(top(a) & top(b)) / min(k, len(a))
+
+def bench_rerank(args):
+    """
+    Reranker throughput and ranking agreement of each backend against the
+    original path (CrossEncoder.predict with default settings).
+    """
+    from sentence_transformers import CrossEncoder
+    from retrieve import load_reranker, RERANKER_MODEL_NAME, TOP_K
+
+    with open(CHUNKS_FILE, "r", encoding="utf-8") as f:
+        texts = [chunk["content"] for chunk in json.load(f)][:args.chunks]
+    queries = SAMPLE_QUERIES[:args.queries]
+    total_pairs = len(queries) * len(texts)
+
+    print(f"\n📊 Reranking {len(queries)} queries x {len(texts)} chunks = {total_pairs} pairs")
+
+    baseline_model = CrossEncoder(RERANKER_MODEL_NAME)
+    start = time.perf_counter()
+    baseline = [list(baseline_model.predict([[q, t] for t in texts])) for q in queries]
+    baseline_s = time.perf_counter() - start
+
+    print(f"{'backend':>24} | {'pairs/s':>8} | {'spearman':>8} | top-{TOP_K} overlap")
+    print("-" * 64)
+    print(f"{'baseline (default)':>24} | {total_pairs / baseline_s:>8.1f} | {1.0:>8.3f} | {1.0:.3f}")
+
+    for backend in args.backends:
+        reranker = load_reranker(backend, max_length=args.max_length, batch_size=args.batch_size)
+        reranker.predict([["warm up", "warm up"]])
+
+        start = time.perf_counter()
+        scores = [reranker.predict([[q, t] for t in texts]) for q in queries]
+        elapsed = time.perf_counter() - start
+
+        rho = statistics.mean(_spearman(b, s) for b, s in zip(baseline, scores))
+        overlap = statistics.mean(_top_overlap(b, s, TOP_K) for b, s in zip(baseline, scores))
+        label = f"{backend} (len {args.max_length}, bs {args.batch_size})"
+        print(f"{label:>24} | {total_pairs / elapsed:>8.1f} | {rho:>8.3f} | {overlap:.3f}")
+
+def bench_batching(args):
+    """
+    Reranker throughput with concurrent callers, each scoring its own
+    candidates: every thread calling predict() directly vs. all of them
+    going through one BatchingReranker.
+    """
+    from retrieve import load_reranker, BatchingReranker
+
+    with open(CHUNKS_FILE, "r", encoding="utf-8") as f:
+        texts = [chunk["content"] for chunk in json.load(f)][:args.pairs]
+    reranker = load_reranker(args.backend)
+    reranker.predict([["warm up", "warm up"]])
+
+    def run(model, threads):
+        def ask(i):
+            for j in range(args.rounds):
+                query = SAMPLE_QUERIES[(i + j) % len(SAMPLE_QUERIES)]
+                model.predict([[query, t] for t in texts])
+
+        workers = [threading.Thread(target=ask, args=(i,)) for i in range(threads)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return threads * args.rounds * len(texts) / (time.perf_counter() - start)
+
+    print(f"\n📊 Reranking {len(texts)} pairs per question, {args.rounds} questions per thread ({args.backend})")
+    print(f"{'threads':>7} | {'direct pairs/s':>14} | {'batched pairs/s':>15} | {'speedup':>7} | pairs per batch")
+    print("-" * 70)
+    for threads in args.threads:
+        direct = run(reranker, threads)
+        batcher = BatchingReranker(reranker, max_batch=args.max_batch, max_wait_ms=args.max_wait_ms)
+        batched = run(batcher, threads)
+        stats = batcher.stats()
+        print(f"{threads:>7} | {direct:>14.1f} | {batched:>15.1f} | {batched / direct:>6.2f}x | "
+              f"{stats['mean_pairs']:.0f} (largest {stats['largest']})")
+
+def bench_ingest(args):
+    """
+    PDF partitioning throughput (pages per second) against worker count.
+    """
+    from ingest import iter_structured_blocks, plan_page_ranges
+
+    ranges = plan_page_ranges(args.file, args.pages_per_task, args.fast_text_pages)
+    pages = ranges[-1][1] if ranges else 0
+
+    print(f"\n📊 Ingesting '{args.file}' ({pages} pages, {args.pages_per_task} pages/task)")
+    print(f"{'workers':>7} | {'seconds':>8} | {'pages/s':>7} | {'blocks':>6}")
+    print("-" * 38)
+    for workers in args.workers:
+        start = time.perf_counter()
+        blocks = sum(1 for _ in iter_structured_blocks(args.file, workers=workers, pages_per_task=args.pages_per_task,
+                                                        fast_text_pages=args.fast_text_pages))
+        elapsed = time.perf_counter() - start
+        print(f"{workers:>7} | {elapsed:>8.1f} | {pages / elapsed:>7.2f} | {blocks:>6}")
+
+def _synthetic_blocks(n_blocks, seed_file):
+    """
+    n_blocks blocks made by repeating seed_file's blocks back to back, with
+    page numbers continuing across copies so every copy reads as new pages.
+    """
+    with open(seed_file, "r", encoding="utf-8") as f:
+        seed = json.load(f)
+    pages = max(block["metadata"]["page"] for block in seed)
+    blocks = []
+    for i in range(n_blocks):
+        block = seed[i % len(seed)]
+        copy = i // len(seed)
+        blocks.append({**block, "metadata": {**block["metadata"], "page": block["metadata"]["page"] + copy * pages}})
+    return blocks
+
+def bench_chunking(args):
+    """
+    Chunker throughput (blocks per second) on synthetic raw_data.json files
+    of growing size, with and without the token budgets.
+    """
+    from chunking import create_semantic_chunks
+
+    print(f"\n📊 Chunking synthetic corpora built from '{args.seed}' (best of {args.repeat} runs)")
+    print(f"{'blocks':>8} | {'MB':>6} | {'budget':>8} | {'chunks':>7} | {'seconds':>7} | {'blocks/s':>9}")
+    print("-" * 62)
+    for n in args.blocks:
+        path = args.output or f"synthetic_raw_data_{n}.json"
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(_synthetic_blocks(n, args.seed), f, ensure_ascii=False)
+        with open(path, "r", encoding="utf-8") as f:
+            blocks = json.load(f)
+        size_mb = sum(len(block["text"]) for block in blocks) / 1e6
+
+        for label, kwargs in (("tokens", {}), ("none", {"max_tokens": None})):
+            best = float("inf")
+            for _ in range(args.repeat):
+                # The chunker mutates nothing in the blocks, so they can be reused
+                start = time.perf_counter()
+                chunks = create_semantic_chunks(blocks, **kwargs)
+                best = min(best, time.perf_counter() - start)
+            print(f"{n:>8} | {size_mb:>6.1f} | {label:>8} | {len(chunks):>7} | {best:>7.2f} | {n / best:>9.0f}")
+
+def bench_generate(args):
+    """
+    Streaming generation latency: time to first token, total time and
+    decode tokens/s. With --fake, runs against fake_llm.py in-process, so
+    it needs neither network nor an API key.
+    """
+    if args.fake:
+        from fake_llm import start_in_background
+
+        start_in_background(first_token_delay=args.first_token_delay, token_delay=args.token_delay)
+
+    import generate
+
+    with open(CHUNKS_FILE, "r", encoding="utf-8") as f:
+        chunks = [{"text": chunk["content"]} for chunk in json.load(f)][:args.chunks]
+
+    runs = []
+    for query in SAMPLE_QUERIES[:args.queries]:
+        stats = {}
+        for _ in generate.stream_completion(generate.build_messages(query, chunks), stats=stats):
+            pass
+        runs.append(stats)
+
+    target = os.environ.get("GROQ_BASE_URL", "Groq API")
+    print(f"\n📊 Streaming generation against {target} ({len(runs)} questions, {len(chunks)} context chunks)")
+    for key, label in (("ttft_ms", "first token ms"), ("total_ms", "total ms"), ("tokens", "tokens"),
+                       ("tokens_per_s", "tokens/s")):
+        values = [run[key] for run in runs]
+        print(f"{label:>15} | median {statistics.median(values):>8.1f} | max {max(values):>8.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="RAG pipeline micro-benchmarks")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    search = sub.add_parser("search", help="Embedding + hybrid search latency vs. number of query variations")
+    search.add_argument("--max-variations", type=int, default=len(SAMPLE_QUERIES))
+    search.add_argument("--repeat", type=int, default=5)
+    search.set_defaults(func=bench_search)
+
+    backends = sub.add_parser("backends", help="Search latency and top-k agreement: local NumPy/BM25 index vs. Qdrant")
+    backends.add_argument("--variations", type=int, default=4, help="Queries searched per call")
+    backends.add_argument("--repeat", type=int, default=20)
+    backends.add_argument("--k", type=int, default=8)
+    backends.set_defaults(func=bench_backends)
+
+    fusion = sub.add_parser("fusion", help="CrossEncoder pairs saved vs. recall when pruning fused candidates")
+    fusion.add_argument("--candidates", type=int, nargs="+", default=[8, 16, 24, 32])
+    fusion.set_defaults(func=bench_fusion)
+
+    rerank = sub.add_parser("rerank", help="Reranker backend throughput and ranking agreement vs. the default CrossEncoder")
+    rerank.add_argument("--backends", nargs="+", default=["torch", "onnx"])
+    rerank.add_argument("--queries", type=int, default=4)
+    rerank.add_argument("--chunks", type=int, default=50)
+    rerank.add_argument("--max-length", type=int, default=512)
+    rerank.add_argument("--batch-size", type=int, default=16)
+    rerank.set_defaults(func=bench_rerank)
+
+    batching = sub.add_parser("batching", help="Reranker pairs/s with concurrent callers, direct vs. micro-batched")
+    batching.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8])
+    batching.add_argument("--pairs", type=int, default=40, help="Candidates per question")
+    batching.add_argument("--rounds", type=int, default=4, help="Questions per thread")
+    batching.add_argument("--backend", default="torch")
+    batching.add_argument("--max-batch", type=int, default=128)
+    batching.add_argument("--max-wait-ms", type=float, default=5.0)
+    batching.set_defaults(func=bench_batching)
+
+    ingest = sub.add_parser("ingest", help="PDF pages per second vs. number of partitioning workers")
+    ingest.add_argument("file")
+    ingest.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    ingest.add_argument("--pages-per-task", type=int, default=10)
+    ingest.add_argument("--fast-text-pages", action="store_true")
+    ingest.set_defaults(func=bench_ingest)
+
+    chunking = sub.add_parser("chunking", help="Chunker blocks per second on synthetic raw_data.json files")
+    chunking.add_argument("--blocks", type=int, nargs="+", default=[10000, 100000, 300000])
+    chunking.add_argument("--seed", default=RAW_BLOCKS_FILE, help="Real raw_data.json whose blocks are repeated")
+    chunking.add_argument("--output", help="Where to write the synthetic file (default: synthetic_raw_data_<n>.json)")
+    chunking.add_argument("--repeat", type=int, default=3)
+    chunking.set_defaults(func=bench_chunking)
+
+    generate = sub.add_parser("generate", help="Time to first token and tokens/s of streaming generation")
+    generate.add_argument("--queries", type=int, default=4)
+    generate.add_argument("--chunks", type=int, default=8, help="Context chunks in the prompt")
+    generate.add_argument("--fake", action="store_true", help="Use an in-process fake_llm.py server instead of Groq")
+    generate.add_argument("--first-token-delay", type=float, default=0.3)
+    generate.add_argument("--token-delay", type=float, default=0.01)
+    generate.set_defaults(func=bench_generate)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,444 @@
+import atexit
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+try:
+    import fcntl
+except ImportError: # Windows: eviction is only serialized within one process
+    fcntl = None
+
+def normalize_query(text):
+    """
+    Lowercases, collapses whitespace and drops trailing punctuation so that
+    "What is X?" and "what is  x" share a cache entry.
+    """
+    text = re.sub(r"\s+", " ", text.strip().lower())
+    return text.rstrip(" ?!.")
+
+def content_digest(text):
+    """
+    Stable short hash of a chunk's text.
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+def _write_json(path, data):
+    # Unique per writer, like DiskCache, so two saves can't replace each other's file
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+class LRUCache:
+    """
+    Thread-safe LRU cache with an optional TTL and optional JSON persistence.
+    Values must be JSON-serializable when a path is given. Saves happen on a
+    background thread every save_every writes (at most once per
+    save_interval seconds), and once more at exit. Hits alone never
+    rewrite the file.
+    """
+
+    def __init__(self, max_size=10000, ttl=None, path=None, save_every=50, save_interval=0.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self.save_every = save_every
+        self.save_interval = save_interval
+
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict() # key -> [stored_at, value]
+        self._unsaved = 0
+        self._saved_at = time.monotonic()
+        self._saving = False
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock() # One writer at a time, snapshots written in order
+
+        if path:
+            self._load()
+            atexit.register(self.save)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"   ⚠️ Ignoring unreadable cache '{self.path}': {e}")
+            return
+        for key, entry in entries:
+            self._entries[key] = entry
+        self._evict()
+
+    def _expired(self, entry):
+        return self.ttl is not None and time.time() - entry[0] > self.ttl
+
+    def _evict(self):
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or self._expired(entry):
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = [time.time(), value]
+            self._entries.move_to_end(key)
+            self._evict()
+            self._unsaved += 1
+            due = (self.path and self._unsaved >= self.save_every and not self._saving
+                   and time.monotonic() - self._saved_at >= self.save_interval)
+            if due:
+                self._saving = True
+        if due:
+            # Rewriting the file is too slow for the request thread
+            threading.Thread(target=self._save_in_background, name="cache-save", daemon=True).start()
+
+    def _save_in_background(self):
+        try:
+            self.save()
+        except OSError as e:
+            print(f"   ⚠️ Could not save cache '{self.path}': {e}")
+        finally:
+            with self._lock:
+                self._saving = False
+
+    def remove_where(self, predicate):
+        """
+        Drops every entry whose key matches predicate. Returns how many went.
+        """
+        with self._lock:
+            stale = [key for key in self._entries if predicate(key)]
+            for key in stale:
+                del self._entries[key]
+            self._unsaved += len(stale)
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._unsaved += 1
+
+    def save(self):
+        if not self.path:
+            return
+        with self._save_lock:
+            with self._lock:
+                if not self._unsaved:
+                    return
+                entries = list(self._entries.items())
+                self._unsaved = 0
+                self._saved_at = time.monotonic()
+            _write_json(self.path, entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._entries),
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+def file_digest(path, extra=None):
+    """
+    SHA-256 of a file's bytes, optionally mixed with a settings dict so the
+    same file processed with different settings gets a different key.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    if extra:
+        digest.update(json.dumps(extra, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+class DiskCache:
+    """
+    Directory of JSON Lines artifacts grouped by key (one folder per key).
+    Entries are written while they stream past and only become visible once
+    complete. When the total size exceeds max_bytes, the least recently used
+    keys are deleted. Several processes can share one root (JobQueue runs
+    ingestion in a pool): eviction takes a file lock and never touches a
+    folder that is still being written or was used in the last min_age
+    seconds.
+    """
+
+    def __init__(self, root, max_bytes=2 * 1024 ** 3, min_age=60.0):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.min_age = min_age # Seconds a key stays safe after get() or a write, while its reader uses it
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key, name):
+        return os.path.join(self.root, key, name)
+
+    def get(self, key, name):
+        """
+        Returns the artifact's path, or None if it isn't cached.
+        """
+        path = self._path(key, name)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+        try:
+            os.utime(os.path.join(self.root, key)) # Mark as recently used
+        except FileNotFoundError: # Evicted by another process just now
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def stream_into(self, key, name, records):
+        """
+        Passes records through while writing them to the cache. If the stream
+        is abandoned, fails or is empty, nothing is cached.
+        """
+        path = self._path(key, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Unique per writer, so two jobs filling the same key can't collide
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        count = 0
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for record in records:
+                    f.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")))
+                    f.write("\n")
+                    count += 1
+                    yield record
+            if count:
+                os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            try:
+                os.rmdir(os.path.dirname(path)) # Only succeeds if nothing was cached
+            except OSError: # Not empty, or another writer already removed it
+                pass
+        self._evict()
+
+    def _folder_size(self, folder):
+        """
+        Bytes of the folder's finished artifacts, or None while another
+        writer still has a .tmp file in it.
+        """
+        size = 0
+        for name in os.listdir(folder):
+            if name.endswith(".tmp"):
+                return None
+            size += os.path.getsize(os.path.join(folder, name))
+        return size
+
+    def _evict(self):
+        with self._lock, open(os.path.join(self.root, ".lock"), "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX) # Released when the file closes
+            entries = []
+            total = 0
+            for key in os.listdir(self.root):
+                folder = os.path.join(self.root, key)
+                try:
+                    if not os.path.isdir(folder):
+                        continue
+                    size = self._folder_size(folder)
+                    mtime = os.path.getmtime(folder)
+                except OSError: # Removed while we looked at it
+                    continue
+                if size is None:
+                    continue # Being written; counts once it is complete
+                entries.append((mtime, size, folder))
+                total += size
+            recent = time.time() - self.min_age
+            for mtime, size, folder in sorted(entries):
+                if total <= self.max_bytes or mtime > recent:
+                    break
+                try:
+                    for name in os.listdir(folder):
+                        if not name.endswith(".tmp"):
+                            os.remove(os.path.join(folder, name))
+                    os.rmdir(folder)
+                except OSError: # A writer started on this key meanwhile; it stays
+                    pass
+                total -= size
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0}
+
+class SemanticCache:
+    """
+    Values keyed by embedding similarity instead of exact text: a lookup
+    hits when a stored vector in the same scope is at least `threshold`
+    cosine-similar. Each entry records the version of the data it was
+    computed from and is dropped once a lookup sees a newer version.
+    LRU + TTL eviction and optional JSON persistence, like LRUCache.
+    """
+
+    def __init__(self, threshold=0.95, max_size=1000, ttl=None, path=None, save_every=10):
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self.save_every = save_every
+
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self._entries = OrderedDict() # key -> {"vector", "scope", "version", "value", "query", "stored_at"}
+        self._vectors = {} # key -> unit-length float32 vector
+        self._next_key = 0
+        self._unsaved = 0
+        self._saving = False
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+
+        if path:
+            self._load()
+            atexit.register(self.save)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"   ⚠️ Ignoring unreadable cache '{self.path}': {e}")
+            return
+        for entry in entries:
+            self._add(entry)
+        self._evict()
+
+    @staticmethod
+    def _unit(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _add(self, entry):
+        key = self._next_key
+        self._next_key += 1
+        self._entries[key] = entry
+        self._vectors[key] = self._unit(entry["vector"])
+
+    def _drop(self, key):
+        del self._entries[key]
+        del self._vectors[key]
+
+    def _evict(self):
+        while len(self._entries) > self.max_size:
+            self._drop(next(iter(self._entries)))
+
+    def get(self, vector, scope, version):
+        """
+        Returns (value, similarity, cached_query) for the closest entry in
+        scope, or None when nothing is similar enough.
+        """
+        query = self._unit(vector)
+        now = time.time()
+        with self._lock:
+            keys = []
+            for key, entry in list(self._entries.items()):
+                if self.ttl is not None and now - entry["stored_at"] > self.ttl:
+                    self._drop(key)
+                elif entry["scope"] == scope:
+                    if entry["version"] != version:
+                        self._drop(key) # Answered from data that has since been re-indexed
+                        self.stale += 1
+                        self._unsaved += 1
+                    else:
+                        keys.append(key)
+
+            if keys:
+                similarities = np.stack([self._vectors[key] for key in keys]) @ query
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    key = keys[best]
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    entry = self._entries[key]
+                    return entry["value"], float(similarities[best]), entry["query"]
+            self.misses += 1
+            return None
+
+    def put(self, vector, scope, version, value, query=None):
+        with self._lock:
+            self._add({
+                "vector": [round(float(x), 6) for x in vector],
+                "scope": scope,
+                "version": version,
+                "value": value,
+                "query": query,
+                "stored_at": time.time(),
+            })
+            self._evict()
+            self._unsaved += 1
+            due = self.path and self._unsaved >= self.save_every and not self._saving
+            if due:
+                self._saving = True
+        if due:
+            threading.Thread(target=self._save_in_background, name="cache-save", daemon=True).start()
+
+    def _save_in_background(self):
+        try:
+            self.save()
+        except OSError as e:
+            print(f"   ⚠️ Could not save cache '{self.path}': {e}")
+        finally:
+            with self._lock:
+                self._saving = False
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._vectors.clear()
+            self._unsaved += 1
+
+    def save(self):
+        if not self.path:
+            return
+        with self._save_lock:
+            with self._lock:
+                if not self._unsaved:
+                    return
+                entries = list(self._entries.values())
+                self._unsaved = 0
+            _write_json(self.path, entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "size": len(self._entries),
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,22 +1,41 @@
 import json
 import re
+import statistics
 
 # --- CONFIGURATION ---
 INPUT_FILE = "raw_data.json"
 OUTPUT_FILE = "semantic_chunks.json"
+MAX_CHUNK_TOKENS = 350 # Leaves room for the query inside 512-token embedder/reranker windows
+MIN_CHUNK_TOKENS = 30 # Smaller chunks are merged into the next one of the same subject
+CHUNK_OVERLAP_TOKENS = 40 # Carried over between the pieces of a split chunk
+
+# Compiled once: detection runs on every block
+_TOKEN = re.compile(r"\w+|[^\w\s]")
+_SENTENCE_END = re.compile(r"(?<=[.!?;:])\s+")
+_NUMBERED_HEADER = re.compile(r"^\[?\d+\]?(\.\d+)*\.?\s")
+_YEAR = re.compile(r"\d{4}")
+_PAGE_LABEL = re.compile(r"Page \d+")
+_SUBJECT = re.compile(r"SUBJECT\s*:\s*(.*)", re.IGNORECASE)
+
+def count_tokens(text):
+    """
+    Cheap tokenizer-free estimate: words and punctuation marks. Tracks
+    WordPiece counts closely for English prose.
+    """
+    return len(_TOKEN.findall(text))
 
 def is_header(text):
     """
     Returns True if the text looks like a standard section header.
     """
     # Pattern 1: Numbered headers (1. Introduction, [1], 2.1 Analysis)
-    if re.match(r'^\[?\d+\]?(\.\d+)*\.?\s', text):
+    if _NUMBERED_HEADER.match(text):
         return True
     
     # Pattern 2: Short, emphatic text (e.g., "EXECUTIVE SUMMARY")
     if len(text) < 60 and (text.isupper() or text.istitle()):
         # Exclude common noise like dates or page numbers
-        if not re.search(r'\d{4}', text) and not re.match(r'Page \d+', text): 
+        if not _YEAR.search(text) and not _PAGE_LABEL.match(text): 
             return True
             
     return False
@@ -26,24 +45,172 @@ def extract_subject_name(text):
     Specific logic to capture the course name from the syllabus file.
     Looks for: "SUBJECT: <NAME>"
     """
-    match = re.search(r'SUBJECT\s*:\s*(.*)', text, re.IGNORECASE)
+    # Cheap substring test first: almost no block mentions a subject
+    if "subject" not in text.casefold():
+        return None
+    match = _SUBJECT.search(text)
     if match:
         return match.group(1).strip()
     return None
 
-def create_semantic_chunks(raw_blocks):
-    chunks = []
-    
+def subject_prefix(subject):
+    return f"Subject: {subject} - "
+
+def _finalize_chunk(chunk):
+    """
+    Freezes a chunk for output and injects its subject context.
+    This is the "Secret Sauce" for Q8, Q9, Q10: we prefix EVERY chunk with
+    its subject name.
+    """
+    chunk["page_numbers"] = sorted(chunk["page_numbers"])
+    tokens = chunk.get("token_count")
+    if tokens is None:
+        tokens = count_tokens(chunk["content"])
+    # If the text doesn't already start with the Subject name...
+    if chunk["subject_context"] not in chunk["content"][:50]:
+        # ...Prepend it!
+        # Example: "Subject: HARDWARE WORKSHOP - [1] ELECTRONIC COMPONENTS..."
+        prefix = subject_prefix(chunk["subject_context"])
+        chunk["content"] = prefix + chunk["content"]
+        tokens += count_tokens(prefix)
+    chunk["token_count"] = tokens
+    return chunk
+
+def _merge_small(chunks, min_tokens):
+    """
+    Folds chunks under min_tokens (a lone header, a one-line section) into
+    the next chunk when both share source and subject. If that pushes the
+    next chunk over budget, the splitter takes care of it.
+    Sets each chunk's token_count so later stages don't recount.
+    """
+    carry = None
+    for chunk in chunks:
+        chunk["token_count"] = count_tokens(chunk["content"])
+        if carry is not None:
+            if carry["source"] == chunk["source"] and carry["subject_context"] == chunk["subject_context"]:
+                # Tokens never span whitespace, so counts add up across the join
+                chunk["content"] = carry["content"] + " " + chunk["content"]
+                chunk["token_count"] += carry["token_count"]
+                chunk["page_numbers"] |= carry["page_numbers"]
+                chunk["section_title"] = carry["section_title"]
+            else:
+                yield carry
+            carry = None
+
+        if chunk["token_count"] < min_tokens:
+            carry = chunk
+        else:
+            yield chunk
+
+    if carry is not None:
+        yield carry
+
+def _split_units(text, max_tokens):
+    """
+    Yields (sentence, tokens), with any sentence longer than max_tokens
+    (tables, run-on lists) hard-split on word boundaries.
+    """
+    for sentence in _SENTENCE_END.split(text.strip()):
+        sentence_tokens = count_tokens(sentence)
+        if sentence_tokens <= max_tokens:
+            yield sentence, sentence_tokens
+            continue
+        piece = []
+        piece_tokens = 0
+        for word in sentence.split():
+            word_tokens = 1 if word.isalnum() else count_tokens(word)
+            if piece and piece_tokens + word_tokens > max_tokens:
+                yield " ".join(piece), piece_tokens
+                piece, piece_tokens = [], 0
+            piece.append(word)
+            piece_tokens += word_tokens
+        if piece:
+            yield " ".join(piece), piece_tokens
+
+def _split_oversized(chunk, max_tokens, overlap_tokens, min_tokens):
+    """
+    Splits a chunk over max_tokens into sentence-aligned pieces that share
+    up to overlap_tokens of trailing context. Each piece keeps the parent's
+    section, subject and pages.
+    """
+    # The subject prefix is added later and counts against the budget
+    budget = max_tokens - count_tokens(subject_prefix(chunk["subject_context"]))
+    if chunk["token_count"] <= budget:
+        yield chunk
+        return
+
+    def piece(window):
+        return {**chunk, "content": " ".join(text for text, _ in window), "page_numbers": set(chunk["page_numbers"]),
+                "token_count": sum(tokens for _, tokens in window)}
+
+    def tail(window, limit, room):
+        # The last units of window totalling at most `limit` tokens, leaving `room` free
+        carried = []
+        carried_tokens = 0
+        for text, tokens in reversed(window):
+            if carried_tokens + tokens > limit or carried_tokens + tokens + room > budget:
+                break
+            carried.insert(0, (text, tokens))
+            carried_tokens += tokens
+        return carried, carried_tokens
+
+    previous = None
+    window = [] # [(text, tokens)]
+    window_tokens = 0
+    for unit, unit_tokens in _split_units(chunk["content"], budget):
+        if window and window_tokens + unit_tokens > budget:
+            yield piece(window)
+            previous = window
+            # Start the next piece with the tail of this one
+            window, window_tokens = tail(window, overlap_tokens, unit_tokens)
+        window.append((unit, unit_tokens))
+        window_tokens += unit_tokens
+
+    if previous is not None and window_tokens < min_tokens:
+        # Don't leave a crumb at the end: borrow more context from the previous piece
+        carried, _ = tail(previous, budget, window_tokens)
+        window = carried + window
+    if window:
+        yield piece(window)
+
+def chunk_length_stats(chunks):
+    """
+    Token-length distribution of finished chunks, for tuning embedding and
+    reranking cost.
+    """
+    lengths = sorted(chunk.get("token_count") or count_tokens(chunk["content"]) for chunk in chunks)
+    if not lengths:
+        return {"chunks": 0}
+    return {
+        "chunks": len(lengths),
+        "min": lengths[0],
+        "p50": lengths[len(lengths) // 2],
+        "p95": lengths[min(len(lengths) - 1, int(len(lengths) * 0.95))],
+        "max": lengths[-1],
+        "mean": round(statistics.mean(lengths), 1),
+        "total": sum(lengths),
+    }
+
+def _iter_section_chunks(raw_blocks):
+    """
+    Incremental chunker: consumes blocks from any iterable in a single pass
+    and yields each raw chunk as soon as the next subject or header closes
+    it. Text is collected in a list and joined once, when the chunk closes.
+    """
     # State tracking
     current_subject = "General Introduction" # Default context
     
     current_chunk = {
         "section_title": "General",
-        "content": "",
         "page_numbers": set(),
         "source": "",
         "subject_context": current_subject
     }
+    parts = [""]
+
+    def close(chunk, parts):
+        chunk["content"] = " ".join(parts)
+        return chunk if chunk["content"].strip() else None
     
     for block in raw_blocks:
         text = block['text']
@@ -54,10 +221,9 @@ def create_semantic_chunks(raw_blocks):
         # If we see "SUBJECT: HARDWARE WORKSHOP", we switch the entire context.
         new_subject = extract_subject_name(text)
         if new_subject:
-            # Save the previous chunk if it has content
-            if current_chunk["content"].strip():
-                current_chunk["page_numbers"] = list(current_chunk["page_numbers"])
-                chunks.append(current_chunk)
+            # Emit the previous chunk if it has content
+            if close(current_chunk, parts):
+                yield current_chunk
             
             # Update the Global Subject
             current_subject = new_subject
@@ -65,53 +231,62 @@ def create_semantic_chunks(raw_blocks):
             # Start a fresh chunk for the new subject
             current_chunk = {
                 "section_title": "Course Introduction",
-                "content": f"Subject: {current_subject}", # Start with the name
                 "page_numbers": {page},
                 "source": source,
                 "subject_context": current_subject
             }
+            parts = [f"Subject: {current_subject}"] # Start with the name
             continue # Skip appending the "SUBJECT: ..." line again to avoid duplicate noise
 
         # 2. CHECK FOR SECTION HEADERS (Local Section Switch)
         if is_header(text):
-            # Save previous chunk
-            if current_chunk["content"].strip():
-                current_chunk["page_numbers"] = list(current_chunk["page_numbers"])
-                chunks.append(current_chunk)
+            # Emit previous chunk
+            if close(current_chunk, parts):
+                yield current_chunk
             
             # Start new chunk
             current_chunk = {
                 "section_title": text,
-                "content": "",
                 "page_numbers": {page},
                 "source": source,
                 "subject_context": current_subject # Carry over the active subject
             }
+            parts = [""]
         
         # 3. APPEND CONTENT
-        # Just add the text normally. We will inject the context in the final step.
-        current_chunk["content"] += " " + text
+        # Just add the text normally. Context is injected when the chunk is emitted.
+        parts.append(text)
         current_chunk["page_numbers"].add(page)
         current_chunk["source"] = source
         # Update context just in case (e.g. for the very first block)
         current_chunk["subject_context"] = current_subject
 
-    # Save the last chunk
-    if current_chunk["content"].strip():
-        current_chunk["page_numbers"] = list(current_chunk["page_numbers"])
-        chunks.append(current_chunk)
-        
-    # --- POST-PROCESSING: INJECT CONTEXT ---
-    # This is the "Secret Sauce" for Q8, Q9, Q10.
-    # We prefix EVERY chunk with its subject name.
+    # Emit the last chunk
+    if close(current_chunk, parts):
+        yield current_chunk
+
+def chunking_settings(max_tokens=MAX_CHUNK_TOKENS, min_tokens=MIN_CHUNK_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS):
+    """
+    Everything that changes chunk output. Part of the ingestion cache key.
+    """
+    return {"max_tokens": max_tokens, "min_tokens": min_tokens, "overlap_tokens": overlap_tokens}
+
+def iter_semantic_chunks(raw_blocks, max_tokens=MAX_CHUNK_TOKENS, min_tokens=MIN_CHUNK_TOKENS,
+                         overlap_tokens=CHUNK_OVERLAP_TOKENS):
+    """
+    Header/subject-aware chunks held within a token budget: tiny sections
+    are merged forward, oversized ones split with overlap. Pass
+    max_tokens=None for unbounded section-sized chunks.
+    """
+    chunks = _iter_section_chunks(raw_blocks)
+    if max_tokens is not None:
+        chunks = _merge_small(chunks, min_tokens)
+        chunks = (piece for chunk in chunks for piece in _split_oversized(chunk, max_tokens, overlap_tokens, min_tokens))
     for chunk in chunks:
-        # If the text doesn't already start with the Subject name...
-        if chunk["subject_context"] not in chunk["content"][:50]:
-            # ...Prepend it!
-            # Example: "Subject: HARDWARE WORKSHOP - [1] ELECTRONIC COMPONENTS..."
-            chunk["content"] = f"Subject: {chunk['subject_context']} - {chunk['content']}"
+        yield _finalize_chunk(chunk)
 
-    return chunks
+def create_semantic_chunks(raw_blocks, **kwargs):
+    return list(iter_semantic_chunks(raw_blocks, **kwargs))
 
 if __name__ == "__main__":
     print("🧠 Starting Context-Aware Semantic Chunking...")
@@ -135,6 +310,8 @@ if __name__ == "__main__":
             if "Subject:" in chunk["content"]:
                 count += 1
         print(f"   {count} chunks have 'Subject:' injected successfully.")
+
+        print(f"\n📏 Chunk length (tokens): {chunk_length_stats(final_chunks)}")
             
     except FileNotFoundError:
         print(f"❌ Error: Could not find '{INPUT_FILE}'.")
\ No newline at end of file
@@ -0,0 +1,142 @@
+from chunking import count_tokens, subject_prefix
+
+# --- CONFIGURATION ---
+CONTEXT_TOKEN_BUDGET = 2500 # Tokens of retrieved text sent to the LLM per question
+DEDUP_THRESHOLD = 0.8 # Share of a passage's word 3-grams already in the context for it to count as a duplicate
+MERGE_ADJACENT = True # Join pieces of the same section into one passage
+MAX_OVERLAP_WORDS = 120 # Longest overlap looked for when joining split pieces
+MIN_OVERLAP_WORDS = 8 # Shortest overlap that counts as one piece continuing another
+# ---------------------
+
+def _strip_subject(text, subject):
+    """
+    Removes the "Subject: ... - " prefix chunking.py injects, since the
+    packed context states each subject once.
+    """
+    prefix = subject_prefix(subject)
+    return (text[len(prefix):] if text.startswith(prefix) else text).strip()
+
+def _shingles(words, n=3):
+    if len(words) < n:
+        return {tuple(words)}
+    return {tuple(words[i:i + n]) for i in range(len(words) - n + 1)}
+
+def _truncate(text, max_tokens):
+    words = []
+    tokens = 0
+    for word in text.split():
+        word_tokens = count_tokens(word)
+        if tokens + word_tokens > max_tokens:
+            break
+        words.append(word)
+        tokens += word_tokens
+    return " ".join(words)
+
+def _join_overlapping(first, second):
+    """
+    Joins two pieces of one section, dropping the words second repeats
+    from the end of first (split pieces share an overlap). Returns None if
+    they don't share at least MIN_OVERLAP_WORDS words, so a common word at
+    the seam doesn't glue unrelated parts of a section together.
+    """
+    a, b = first.split(), second.split()
+    for k in range(min(len(a), len(b), MAX_OVERLAP_WORDS), MIN_OVERLAP_WORDS - 1, -1):
+        if a[-k:] == b[:k]:
+            return " ".join(a + b[k:])
+    return None
+
+def pack_context(chunks, token_budget=CONTEXT_TOKEN_BUDGET, dedup_threshold=DEDUP_THRESHOLD,
+                 merge_adjacent=MERGE_ADJACENT):
+    """
+    Builds the LLM context from reranked chunks (best first, as returned by
+    search_and_rerank). Passages are taken in score order until the token
+    budget is full; near-duplicates are skipped, pieces of the same section
+    can be joined, and each subject is stated once instead of per chunk.
+    Source numbers stay the chunks' ranks, so citations match the UI; a
+    joined passage is labelled with every rank it contains.
+    Returns (context_text, report).
+    """
+    naive_tokens = sum(count_tokens(f"\n[Source {i+1}]: {chunk['text']}") for i, chunk in enumerate(chunks))
+
+    passages = [] # {"ranks", "subject", "key", "text"}
+    seen = set()
+    duplicates = 0
+    over_budget = 0
+    used = 0
+    for rank, chunk in enumerate(chunks, start=1):
+        meta = chunk.get("meta", {})
+        subject = meta.get("subject_context") or "General"
+        text = _strip_subject(chunk["text"], subject)
+        words = text.split()
+        if not words:
+            continue
+
+        shingles = _shingles(words)
+        if passages and len(shingles & seen) / len(shingles) >= dedup_threshold:
+            duplicates += 1
+            continue
+
+        tokens = count_tokens(text)
+        if used + tokens > token_budget:
+            if passages:
+                over_budget += 1
+                continue
+            # Never send an empty context: cut the best chunk down to the budget
+            text = _truncate(text, token_budget)
+            tokens = count_tokens(text)
+
+        seen |= shingles
+        used += tokens
+        passages.append({
+            "ranks": [rank],
+            "subject": subject,
+            "key": (meta.get("source"), meta.get("section_title"), subject),
+            "text": text,
+        })
+
+    merged = 0
+    if merge_adjacent:
+        joined = []
+        for passage in passages:
+            for earlier in joined:
+                if earlier["key"] != passage["key"]:
+                    continue
+                text = (_join_overlapping(earlier["text"], passage["text"])
+                        or _join_overlapping(passage["text"], earlier["text"]))
+                if text is not None:
+                    earlier["text"] = text
+                    earlier["ranks"] = sorted(earlier["ranks"] + passage["ranks"])
+                    merged += 1
+                    break
+            else:
+                joined.append(passage)
+        passages = joined
+
+    # Group by subject, in order of each subject's best passage
+    subjects = []
+    for passage in passages:
+        if passage["subject"] not in subjects:
+            subjects.append(passage["subject"])
+    sections = []
+    for subject in subjects:
+        lines = [f"Subject: {subject}"]
+        lines += [f"[Source {', '.join(map(str, p['ranks']))}]: {p['text']}"
+                  for p in passages if p["subject"] == subject]
+        sections.append("\n".join(lines))
+    context_text = "\n\n".join(sections)
+
+    packed_tokens = count_tokens(context_text)
+    report = {
+        "chunks": len(chunks),
+        "passages": len(passages),
+        "duplicates": duplicates,
+        "over_budget": over_budget,
+        "merged": merged,
+        "tokens_before": naive_tokens,
+        "tokens_after": packed_tokens,
+        "tokens_saved": naive_tokens - packed_tokens,
+    }
+    print(f"   📦 Context: {len(chunks)} chunks -> {len(passages)} passages "
+          f"({duplicates} duplicate, {over_budget} over budget, {merged} merged), "
+          f"{naive_tokens} -> {packed_tokens} tokens ({report['tokens_saved']} saved)")
+    return context_text, report
@@ -0,0 +1,85 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+# --- CONFIGURATION ---
+REGISTRY_FILE = "corpus_registry.json"
+DEFAULT_COLLECTION = "rag_collection_demo"
+# ---------------------
+
+# Callers each build their own CorpusRegistry, so updates are serialized per process, not per instance
+_write_lock = threading.Lock()
+
+class CorpusRegistry:
+    """
+    Tracks which documents are indexed, in which collection, and which
+    subjects and pages they cover. Lets the retriever route a source filter
+    to the right collections and lets the UI offer per-document filters.
+    """
+
+    def __init__(self, path=REGISTRY_FILE):
+        self.path = path
+        self.documents = {}
+        self._reload()
+
+    def _reload(self):
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.documents = json.load(f)
+
+    def _save(self):
+        # Unique per writer, so a concurrent save can't replace this one's file
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.documents, f, indent=2, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def register(self, source, collection, chunk_count, pages, subjects, fingerprints=()):
+        """
+        Records (or refreshes) a document from the summary of what was indexed for it.
+        """
+        with _write_lock:
+            self._reload() # Keep what other registries wrote since this one was loaded
+            self.documents[source] = {
+                "collection": collection,
+                "chunks": chunk_count,
+                "pages": len(pages),
+                "subject_context": sorted(subjects),
+                "indexed_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+                # Point ID + payload hash per chunk, so this changes with any edit
+                "points_digest": hashlib.sha256("\n".join(sorted(fingerprints)).encode("utf-8")).hexdigest()[:16],
+            }
+            self._save()
+
+    def sources(self):
+        return sorted(self.documents)
+
+    def subjects(self, sources=None):
+        sources = sources or self.sources()
+        return sorted({s for source in sources for s in self.documents.get(source, {}).get("subject_context", [])})
+
+    def collections(self, sources=None, default=DEFAULT_COLLECTION):
+        """
+        Collections holding the given sources (all known ones by default).
+        """
+        sources = sources or self.sources()
+        found = sorted({self.documents[s]["collection"] for s in sources if s in self.documents})
+        return found or [default]
+
+    def version(self, collections):
+        """
+        Changes whenever the indexed content of these collections changes:
+        a document added or edited. Lets caches built on search
+        results notice re-indexing, even when it happened in another process.
+        """
+        docs = sorted(
+            (source, doc.get("points_digest", doc["indexed_at"]), doc["chunks"])
+            for source, doc in self.documents.items() if doc["collection"] in collections
+        )
+        return hashlib.sha256(json.dumps([sorted(collections), docs]).encode("utf-8")).hexdigest()[:16]
@@ -0,0 +1,316 @@
+import argparse
+import json
+import random
+import re
+import statistics
+import time
+from index import chunk_id
+from artifacts import read_records
+from chunking import subject_prefix
+from tracing import Trace, trace
+
+# --- CONFIGURATION ---
+QUESTIONS_FILE = "eval_questions.json" # [{"question", "relevant": [chunk ids], "relevant_text": [substrings]}, ...]
+CHUNKS_FILE = None # .json/.jsonl chunks to resolve relevant_text labels against; None reads what is indexed
+RESULTS_FILE = "eval_results.json"
+K_VALUES = (1, 3, 5, 8) # Cutoffs for recall@k (the reranked list holds TOP_K chunks)
+GENERATED_QUESTIONS = 50 # Known-item questions made by --make-questions
+MIN_QUESTION_WORDS = 6
+MAX_QUESTION_WORDS = 30
+WARMUP_QUESTIONS = 2 # Run first and left out of the latency numbers
+# ---------------------
+
+def make_questions(chunks, n=GENERATED_QUESTIONS, seed=0):
+    """
+    Known-item questions: a sentence taken from a chunk is the question and
+    every chunk containing it is relevant. Cheap and label-free, and good
+    enough to catch regressions; hand-written questions with
+    "relevant_text" labels can be added to the same file.
+    """
+    rng = random.Random(seed)
+    candidates = []
+    for chunk in chunks:
+        text = chunk["content"]
+        prefix = subject_prefix(chunk.get("subject_context") or "General")
+        if text.startswith(prefix):
+            text = text[len(prefix):]
+        sentences = [s.strip() for s in re.split(r"(?<=[.!?])\s+", text)]
+        sentences = [s for s in sentences if MIN_QUESTION_WORDS <= len(s.split()) <= MAX_QUESTION_WORDS]
+        if sentences:
+            candidates.append(rng.choice(sentences))
+
+    questions = []
+    for sentence in rng.sample(candidates, min(n, len(candidates))):
+        relevant = sorted({chunk_id(c) for c in chunks if sentence in c["content"]})
+        questions.append({"question": sentence.rstrip(".!?"), "relevant": relevant})
+    return questions
+
+def indexed_chunks(retriever):
+    """
+    Every chunk in the collections the retriever searches, read back from
+    the stored payloads, so labels resolve against what is actually indexed.
+    """
+    chunks = []
+    for collection_name in retriever._collections_for(None):
+        offset = None
+        while True:
+            with retriever.client_lock:
+                points, offset = retriever.client.scroll(
+                    collection_name=collection_name,
+                    with_payload=True,
+                    limit=1000,
+                    offset=offset,
+                )
+            chunks.extend({k: v for k, v in point.payload.items() if k != "document"} for point in points)
+            if offset is None:
+                break
+    return chunks
+
+def load_questions(path, chunks):
+    """
+    Reads the question set and turns every label into a set of chunk ids.
+    relevant_text matches any chunk whose content contains it (case-insensitive).
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        questions = json.load(f)
+
+    loaded = []
+    for q in questions:
+        relevant = set(q.get("relevant", []))
+        for text in q.get("relevant_text", []):
+            needle = text.casefold()
+            relevant.update(chunk_id(c) for c in chunks if needle in c["content"].casefold())
+        if not relevant:
+            print(f"   ⚠️ Skipping '{q['question']}': no chunk matches its labels.")
+            continue
+        loaded.append({"question": q["question"], "relevant": relevant, "filters": q.get("filters")})
+    return loaded
+
+def _first_hit(ranking, relevant):
+    for rank, point_id in enumerate(ranking, start=1):
+        if point_id in relevant:
+            return rank
+    return None
+
+def _ranking_metrics(rankings, k_values, depth):
+    """
+    Mean recall@k and MRR over (ranking, relevant) pairs. MRR is cut at
+    depth, so the fused and the reranked lists are scored alike.
+    """
+    metrics = {}
+    for k in k_values:
+        metrics[f"recall@{k}"] = statistics.mean(
+            len(set(ranking[:k]) & relevant) / len(relevant) for ranking, relevant in rankings
+        )
+    ranks = [_first_hit(ranking[:depth], relevant) for ranking, relevant in rankings]
+    metrics[f"mrr@{depth}"] = statistics.mean(1 / rank if rank else 0.0 for rank in ranks)
+    return metrics
+
+def percentile(values, p):
+    """
+    p-th percentile (0-100) with linear interpolation between samples.
+    """
+    values = sorted(values)
+    position = (len(values) - 1) * p / 100
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+def _latency_summary(samples_ms):
+    mean = statistics.mean(samples_ms)
+    return {
+        "p50": round(percentile(samples_ms, 50), 3),
+        "p95": round(percentile(samples_ms, 95), 3),
+        "mean": round(mean, 3),
+        "per_s": round(1000 / mean, 2) if mean else None, # Calls per second on one thread
+        "calls": len(samples_ms),
+    }
+
+def _stage_samples(question_trace, timings):
+    # Span timings when tracing is on, the question's own stage timer otherwise
+    if isinstance(question_trace, Trace):
+        samples = {}
+        for s in question_trace.spans:
+            samples.setdefault(s["name"], []).append(s["duration_ms"])
+        return {name: [sum(values)] for name, values in samples.items()}
+    return {name: [seconds * 1000] for name, seconds in timings.items()
+            if name not in ("setup", "work", "total")}
+
+def _start_fake_llm():
+    """
+    Stubs out the network: query expansion talks to an in-process
+    fake_llm.py, and its variations stay out of the real expansion cache.
+    """
+    from fake_llm import start_in_background
+
+    start_in_background(first_token_delay=0.05, token_delay=0.0)
+
+    import retrieve
+    from cache import LRUCache
+    retrieve._expansion_cache = LRUCache(max_size=retrieve.EXPANSION_CACHE_SIZE)
+
+def run_eval(questions, retriever, expand=False, k_values=K_VALUES, warmup=WARMUP_QUESTIONS):
+    """
+    Asks every question through Retriever.search_and_rerank_with_report and
+    scores both the fused ranking (before reranking) and the reranked top-k.
+    """
+    from retrieve import TOP_K, _hit_payload
+
+    for q in questions[:warmup]:
+        retriever.search_and_rerank(q["question"], expand=expand, filters=q["filters"])
+
+    before, after, per_question = [], [], []
+    stages = {}
+    totals = []
+    pairs = 0
+    for q in questions:
+        start = time.perf_counter()
+        with trace("eval", question=q["question"]) as question_trace:
+            results, report = retriever.search_and_rerank_with_report(q["question"], expand=expand,
+                                                                      filters=q["filters"])
+        totals.append((time.perf_counter() - start) * 1000)
+
+        fused = [chunk_id(_hit_payload(hit)) for _, hit in report["fused"]]
+        reranked = [chunk_id(chunk["meta"]) for chunk in results]
+        before.append((fused, q["relevant"]))
+        after.append((reranked, q["relevant"]))
+        pairs += report["counts"].get("reranked", 0)
+        for name, samples in _stage_samples(question_trace, report["timings"]).items():
+            stages.setdefault(name, []).extend(samples)
+        per_question.append({
+            "question": q["question"],
+            "rank_before": _first_hit(fused, q["relevant"]),
+            "rank_after": _first_hit(reranked, q["relevant"]),
+            "ms": round(totals[-1], 3),
+        })
+
+    k_values = [k for k in k_values if k <= TOP_K]
+    rerank_ms = sum(stages.get("retrieve.rerank", stages.get("rerank", [])))
+    return {
+        "questions": len(questions),
+        "retrieval": {
+            "before_rerank": _ranking_metrics(before, k_values, TOP_K),
+            "after_rerank": _ranking_metrics(after, k_values, TOP_K),
+        },
+        "latency_ms": {"total": _latency_summary(totals),
+                       **{name: _latency_summary(samples) for name, samples in sorted(stages.items())}},
+        "throughput": {
+            "questions_per_s": round(len(questions) / (sum(totals) / 1000), 2),
+            "rerank_pairs_per_s": round(pairs / (rerank_ms / 1000), 1) if rerank_ms else None,
+        },
+        "per_question": per_question,
+    }
+
+def _settings(retriever, expand, chunks_file):
+    import retrieve
+
+    return {
+        "chunks_file": chunks_file or "indexed",
+        "collection": retriever.collection_name,
+        "search_backend": retriever.search_backend,
+        "search_limit": retrieve.SEARCH_LIMIT,
+        "fusion": retriever.fusion_method,
+        "rerank_candidates": retriever.rerank_candidates,
+        "reranker_model": retriever.reranker_model_name,
+        "reranker_backend": retriever.reranker_backend,
+        "top_k": retrieve.TOP_K,
+        "expand": expand,
+    }
+
+def print_report(results, baseline=None):
+    def delta(section, key, value):
+        if not baseline:
+            return ""
+        old = baseline
+        for part in section:
+            old = old.get(part, {})
+        old = old.get(key) if isinstance(old, dict) else None
+        return f" ({value - old:+.3f})" if isinstance(old, (int, float)) and value is not None else ""
+
+    print(f"\n📊 Retrieval eval over {results['questions']} questions")
+    before = results["retrieval"]["before_rerank"]
+    after = results["retrieval"]["after_rerank"]
+    print(f"{'metric':>10} | {'before rerank':>20} | {'after rerank':>20}")
+    print("-" * 58)
+    for key in before:
+        b = f"{before[key]:.3f}{delta(('retrieval', 'before_rerank'), key, before[key])}"
+        a = f"{after[key]:.3f}{delta(('retrieval', 'after_rerank'), key, after[key])}"
+        print(f"{key:>10} | {b:>20} | {a:>20}")
+
+    print(f"\n{'stage':>24} | {'p50 ms':>16} | {'p95 ms':>16} | {'calls/s':>8}")
+    print("-" * 74)
+    for name, s in results["latency_ms"].items():
+        p50 = f"{s['p50']:.1f}{delta(('latency_ms', name), 'p50', s['p50'])}"
+        p95 = f"{s['p95']:.1f}{delta(('latency_ms', name), 'p95', s['p95'])}"
+        print(f"{name:>24} | {p50:>16} | {p95:>16} | {s['per_s'] or 0:>8.1f}")
+    throughput = results["throughput"]
+    print(f"\n   ⚡ {throughput['questions_per_s']} questions/s, {throughput['rerank_pairs_per_s']} rerank pairs/s")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline retrieval accuracy + latency eval against the indexed corpus")
+    parser.add_argument("--questions", default=QUESTIONS_FILE)
+    parser.add_argument("--make-questions", type=int, metavar="N",
+                        help="Write N known-item questions from the chunks to --questions first")
+    parser.add_argument("--chunks", default=CHUNKS_FILE,
+                        help=".json or .jsonl chunks file (default: read the indexed collections)")
+    parser.add_argument("--output", default=RESULTS_FILE)
+    parser.add_argument("--baseline", help="Earlier results file to diff against")
+    parser.add_argument("--expand", action="store_true", help="Include query expansion, answered by a fake LLM")
+    parser.add_argument("--search-limit", type=int)
+    parser.add_argument("--candidates", type=int, help="Fused candidates sent to the reranker")
+    parser.add_argument("--reranker-model")
+    parser.add_argument("--reranker-backend")
+    parser.add_argument("--fusion", choices=["rrf", "weighted"])
+    parser.add_argument("--search-backend", choices=["qdrant", "local"])
+    parser.add_argument("--warmup", type=int, default=WARMUP_QUESTIONS)
+    args = parser.parse_args()
+
+    if args.expand:
+        _start_fake_llm()
+    import retrieve
+    from retrieve import Retriever
+
+    if args.search_limit:
+        retrieve.SEARCH_LIMIT = args.search_limit # Read per call by Retriever.search_variations
+    options = {"use_score_cache": False} # Cached scores would hide the reranker's cost
+    if args.candidates:
+        options["rerank_candidates"] = args.candidates
+    if args.reranker_model:
+        options["reranker_model_name"] = args.reranker_model
+    if args.reranker_backend:
+        options["reranker_backend"] = args.reranker_backend
+    if args.fusion:
+        options["fusion_method"] = args.fusion
+    if args.search_backend:
+        options["search_backend"] = args.search_backend
+    retriever = Retriever(**options).warm_up()
+
+    chunks = list(read_records(args.chunks)) if args.chunks else indexed_chunks(retriever)
+    if args.make_questions:
+        with open(args.questions, "w", encoding="utf-8") as f:
+            json.dump(make_questions(chunks, args.make_questions), f, indent=2, ensure_ascii=False)
+        print(f"📝 Wrote {args.make_questions} questions to '{args.questions}'")
+
+    questions = load_questions(args.questions, chunks)
+    if not questions:
+        print(f"❌ No usable questions in '{args.questions}'. Create some with --make-questions.")
+        return
+    results = {"settings": _settings(retriever, args.expand, args.chunks),
+               **run_eval(questions, retriever, expand=args.expand, warmup=args.warmup)}
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        changed = {k: (v, results["settings"][k]) for k, v in baseline.get("settings", {}).items()
+                   if results["settings"].get(k) != v}
+        if changed:
+            print(f"   ℹ️ Settings changed vs. baseline: {changed}")
+    print_report(results, baseline)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+    print(f"💾 Results saved to '{args.output}'")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+import argparse
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# --- CONFIGURATION ---
+HOST = "127.0.0.1"
+PORT = 8001
+FIRST_TOKEN_DELAY = 0.3 # Seconds before the first token (prompt processing)
+TOKEN_DELAY = 0.01 # Seconds between streamed tokens
+ANSWER_TOKENS = 120 # Length of the canned answer
+ERROR_RATE = 0.0 # Share of requests answered with a 503, to exercise client retries
+# ---------------------
+
+def _fake_answer(messages, answer_tokens):
+    """
+    Canned reply shaped like the real one: three lines for query expansion
+    prompts, otherwise a cited answer of answer_tokens words.
+    """
+    prompt = messages[-1]["content"] if messages else ""
+    question = re.search(r'User Question: "(.*)"', prompt)
+    if question:
+        q = question.group(1)
+        return f"{q}\nKey facts about {q}\nDetails and explanation of {q}"
+
+    words = f"Based on the provided documents, the answer to '{prompt}' is as follows [Source 1].".split()
+    filler = "The context describes this topic in detail [Source 2].".split()
+    while len(words) < answer_tokens:
+        words += filler
+    return " ".join(words[:answer_tokens])
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    """
+    Serves POST .../chat/completions in the OpenAI/Groq wire format, with
+    optional SSE streaming. Point the app at it with GROQ_BASE_URL.
+    """
+    protocol_version = "HTTP/1.1" # Keep-alive, like the real API
+    first_token_delay = FIRST_TOKEN_DELAY
+    token_delay = TOKEN_DELAY
+    answer_tokens = ANSWER_TOKENS
+    error_rate = ERROR_RATE
+
+    def log_message(self, format, *args):
+        pass # One line per request would drown load tests
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if not self.path.endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+        if random.random() < self.error_rate:
+            self._send_json(503, {"error": {"message": "Fake overload, try again"}})
+            return
+
+        answer = _fake_answer(request.get("messages", []), self.answer_tokens)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        model = request.get("model", "fake")
+        created = int(time.time())
+        time.sleep(self.first_token_delay)
+
+        if not request.get("stream"):
+            time.sleep(self.token_delay * len(answer.split()))
+            self._send_json(200, {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": len(answer.split()), "total_tokens": len(answer.split())},
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def send_event(payload):
+            data = f"data: {payload}\n\n".encode("utf-8")
+            self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+        def chunk(delta, finish_reason=None):
+            return json.dumps({
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            })
+
+        try:
+            # One event per word, the way the real API streams roughly one token at a time
+            for i, word in enumerate(re.findall(r"\S+\s*", answer)):
+                if i:
+                    time.sleep(self.token_delay)
+                send_event(chunk({"role": "assistant", "content": word} if i == 0 else {"content": word}))
+            send_event(chunk({}, finish_reason="stop"))
+            send_event("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True # Client stopped reading mid-answer
+
+def serve(host=HOST, port=PORT, first_token_delay=FIRST_TOKEN_DELAY, token_delay=TOKEN_DELAY,
+          answer_tokens=ANSWER_TOKENS, error_rate=ERROR_RATE):
+    """
+    Builds (but doesn't start) a threaded fake LLM server. Call
+    serve_forever() on it, or run it in a thread for tests.
+    """
+    handler = type("ConfiguredFakeLLMHandler", (FakeLLMHandler,), {
+        "first_token_delay": first_token_delay,
+        "token_delay": token_delay,
+        "answer_tokens": answer_tokens,
+        "error_rate": error_rate,
+    })
+    return ThreadingHTTPServer((host, port), handler)
+
+def start_in_background(**kwargs):
+    """
+    Runs a fake server (serve() options; a free port by default) on a
+    daemon thread and points llm.py at it. Call before llm.py is imported,
+    since it reads GROQ_BASE_URL once.
+    """
+    server = serve(**{"port": 0, **kwargs})
+    threading.Thread(target=server.serve_forever, name="fake-llm", daemon=True).start()
+    host, port = server.server_address[:2]
+    os.environ["GROQ_BASE_URL"] = f"http://{host}:{port}"
+    os.environ.setdefault("GROQ_API_KEY", "fake")
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the Groq chat completions API")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--first-token-delay", type=float, default=FIRST_TOKEN_DELAY)
+    parser.add_argument("--token-delay", type=float, default=TOKEN_DELAY)
+    parser.add_argument("--answer-tokens", type=int, default=ANSWER_TOKENS)
+    parser.add_argument("--error-rate", type=float, default=ERROR_RATE)
+    args = parser.parse_args()
+
+    server = serve(args.host, args.port, args.first_token_delay, args.token_delay, args.answer_tokens, args.error_rate)
+    print(f"🧪 Fake LLM listening on http://{args.host}:{args.port}")
+    print(f"   Use it with: GROQ_BASE_URL=http://{args.host}:{args.port} GROQ_API_KEY=fake python generate.py")
+    server.serve_forever()
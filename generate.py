@@ -1,31 +1,41 @@
-import os
-from groq import Groq
-from retrieve import search_and_rerank # Import Step 4
-from dotenv import load_dotenv
+import json
+import time
+from retrieve import search_and_rerank, get_retriever, EXPANSION_ENABLED # Import Step 4
+from context import pack_context
+from cache import SemanticCache
+from llm import get_llm
+from tracing import trace, span, annotate, count
 
-load_dotenv()
 # --- CONFIGURATION ---
-# Replace with your actual key!
-API_KEY = os.getenv("GROQ_API_KEY")
+# API key, server and connection pool settings live in llm.py
 MODEL_NAME = "llama-3.3-70b-versatile" # The smartest model on Groq
+ANSWER_CACHE_ENABLED = True
+ANSWER_CACHE_THRESHOLD = 0.95 # Cosine similarity for two questions to share an answer
+ANSWER_CACHE_SIZE = 1000
+ANSWER_CACHE_TTL = 24 * 3600 # Seconds
+ANSWER_CACHE_PATH = "answer_cache.json" # None keeps the cache in memory only
 # ---------------------
 
-def generate_answer(query):
-    print(f"🤖 RAG System processing: '{query}'")
-    
-    # 1. RETRIEVE (Step 4)
-    # Get the top 5 chunks using our Hybrid + Reranking engine
-    retrieved_chunks = search_and_rerank(query)
-    
-    if not retrieved_chunks:
-        return "Sorry, I couldn't find any information in the documents."
+_answer_cache = SemanticCache(threshold=ANSWER_CACHE_THRESHOLD, max_size=ANSWER_CACHE_SIZE,
+                              ttl=ANSWER_CACHE_TTL, path=ANSWER_CACHE_PATH)
+
+NO_CONTEXT_ANSWER = "Sorry, I couldn't find any information in the documents."
 
+def build_messages(query, retrieved_chunks, stats=None):
+    """
+    System prompt with the packed, numbered context, plus the user's
+    question. If a stats dict is given, the packing report goes in
+    stats["context"].
+    """
     # 2. CONTEXT PREPARATION
-    # We stitch the chunks together into one big text block.
-    # We also include the source metadata so the LLM can cite it.
-    context_text = ""
-    for i, chunk in enumerate(retrieved_chunks):
-        context_text += f"\n[Source {i+1}]: {chunk['text']}"
+    # Chunks are packed into a token budget: duplicates dropped, pieces of a
+    # section joined, and each subject stated once. Source numbers stay the
+    # chunks' ranks so the LLM can cite them.
+    with span("context.pack", chunks=len(retrieved_chunks)):
+        context_text, report = pack_context(retrieved_chunks)
+    annotate(context_tokens=report["tokens_after"], context_tokens_saved=report["tokens_saved"])
+    if stats is not None:
+        stats["context"] = report
 
     # 3. PROMPT ENGINEERING (The System Prompt)
     # This instructs the AI specifically on HOW to answer.
@@ -52,38 +62,138 @@ def generate_answer(query):
     {context_text}
     """
 
+    return [
+        {
+            "role": "system",
+            "content": system_prompt
+        },
+        {
+            "role": "user",
+            "content": query,
+        }
+    ]
+
+def stream_completion(messages, stats=None, model=MODEL_NAME):
+    """
+    Yields the answer text piece by piece as the LLM streams it. If a stats
+    dict is given, it is filled with time-to-first-token, token count and
+    tokens per second once the stream ends.
+    """
+    start = time.perf_counter()
+    first_token_at = None
+    tokens = 0
+
+    for text in get_llm().stream(messages, model, temperature=0.0): # Keep it factual (0 creativity)
+        if first_token_at is None:
+            first_token_at = time.perf_counter()
+        tokens += 1 # Groq streams one token per chunk
+        yield text
+
+    end = time.perf_counter()
+    first_token_at = first_token_at or end
+    decode_s = end - first_token_at
+    result = {
+        "ttft_ms": (first_token_at - start) * 1000,
+        "total_ms": (end - start) * 1000,
+        "tokens": tokens,
+        # Decode speed: time after the first token, so prompt processing doesn't count
+        "tokens_per_s": (tokens - 1) / decode_s if tokens > 1 and decode_s > 0 else 0.0,
+    }
+    if stats is not None:
+        stats.update(result)
+    annotate(**result)
+    print(f"   ⏱️ First token after {result['ttft_ms']:.0f} ms, {tokens} tokens at "
+          f"{result['tokens_per_s']:.1f} tokens/s ({result['total_ms']:.0f} ms total)")
+
+def stream_answer(query, retrieved_chunks=None, stats=None):
+    """
+    Streaming version of generate_answer: yields answer text as it is
+    generated. Pass retrieved_chunks to skip retrieval (e.g. when the
+    caller already displayed them).
+    """
+    print(f"🤖 RAG System processing: '{query}'")
+
+    # 1. RETRIEVE (Step 4)
+    # Get the top chunks using our Hybrid + Reranking engine
+    if retrieved_chunks is None:
+        retrieved_chunks = search_and_rerank(query)
+
+    if not retrieved_chunks:
+        yield NO_CONTEXT_ANSWER
+        return
+
     # 4. CALL LLM API (Groq)
     print("   ...Synthesizing answer with Llama 3 (Groq)...")
-    
-    client = Groq(api_key=API_KEY)
-    
-    chat_completion = client.chat.completions.create(
-        messages=[
-            {
-                "role": "system",
-                "content": system_prompt
-            },
-            {
-                "role": "user",
-                "content": query,
-            }
-        ],
-        model=MODEL_NAME,
-        temperature=0.0, # Keep it factual (0 creativity)
-    )
-
-    # 5. OUTPUT
-    answer = chat_completion.choices[0].message.content
-    return answer
+    yield from stream_completion(build_messages(query, retrieved_chunks, stats=stats), stats=stats)
+
+def _cache_scope(filters):
+    # Answers are only shared between questions asked with the same model and filters
+    scope = {field: sorted([values] if isinstance(values, str) else values)
+             for field, values in (filters or {}).items() if values}
+    return json.dumps({"model": MODEL_NAME, "filters": scope}, sort_keys=True)
+
+def cached_answer(query, filters=None):
+    """
+    Looks the question up in the semantic answer cache. Returns (hit, key):
+    hit is {"answer", "chunks", "similarity", "query"} or None, and key is
+    what remember_answer needs to store a fresh answer after a miss.
+    """
+    if not ANSWER_CACHE_ENABLED:
+        return None, None
+
+    retriever = get_retriever()
+    # The corpus version is taken before retrieval, so an answer is never
+    # stored under a version newer than the chunks it was built from
+    with span("answer_cache.lookup") as s:
+        key = (retriever.embed_query(query), _cache_scope(filters), retriever.corpus_version(filters))
+        found = _answer_cache.get(*key)
+        s.set(hit=found is not None)
+    annotate(answer_cache_hit=found is not None)
+    if found is None:
+        count("answer_cache.misses")
+        return None, key
+    count("answer_cache.hits")
+
+    value, similarity, cached_query = found
+    print(f"   💾 Answer cache hit: {similarity:.3f} similar to '{cached_query}' "
+          f"(hit rate {_answer_cache.stats()['hit_rate']:.0%})")
+    return {"answer": value["answer"], "chunks": value["chunks"], "similarity": similarity, "query": cached_query}, key
+
+def remember_answer(key, query, answer, retrieved_chunks):
+    """
+    Stores an answer and its sources under the key from cached_answer.
+    Answers without sources aren't cached.
+    """
+    if key is None or not retrieved_chunks:
+        return
+    _answer_cache.put(*key, {"answer": answer, "chunks": retrieved_chunks}, query=query)
+
+def answer_cache_stats():
+    return _answer_cache.stats()
+
+def generate_answer(query, filters=None, expand=EXPANSION_ENABLED):
+    with trace("answer", query=query):
+        hit, key = cached_answer(query, filters)
+        if hit:
+            return hit["answer"]
+
+        retrieved_chunks = search_and_rerank(query, expand=expand, filters=filters)
+        # 5. OUTPUT
+        answer = "".join(stream_answer(query, retrieved_chunks))
+        remember_answer(key, query, answer, retrieved_chunks)
+        return answer
 
 if __name__ == "__main__":
     # Test Question
     user_query = "What are the new job roles mentioned in the report?"
-    
-    final_response = generate_answer(user_query)
-    
+
+    # Load models before the question, not during it
+    get_retriever().warm_up()
+
     print("\n" + "="*50)
     print("FINAL ANSWER:")
     print("="*50)
-    print(final_response)
-    print("="*50)
\ No newline at end of file
+    # Print tokens as they arrive instead of waiting for the whole answer
+    for text in stream_answer(user_query):
+        print(text, end="", flush=True)
+    print("\n" + "="*50)
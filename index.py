@@ -1,62 +1,375 @@
+import argparse
+import contextlib
+import hashlib
+import itertools
 import json
 import os
+import time
+import uuid
 from qdrant_client import QdrantClient
 from qdrant_client.http import models
+from corpus import CorpusRegistry
+from cache import content_digest
+from artifacts import read_records
+from tracing import trace, span, record, count, annotate
 
 # --- CONFIGURATION ---
 INPUT_FILE = "semantic_chunks.json"
 COLLECTION_NAME = "rag_collection_demo"  # Name of your database table
+EMBED_BATCH_SIZE = 32 # Texts per FastEmbed forward pass
+EMBED_WORKERS = None # FastEmbed worker processes (None = in-process, 0 = all cores)
+UPSERT_BATCH_SIZE = 256 # Points embedded and committed together; bounds memory
+REUSE_VECTORS = True # Copy vectors from already-indexed chunks with the same text (e.g. a renamed re-upload)
+PAYLOAD_INDEXES = {
+    "source": models.PayloadSchemaType.KEYWORD,
+    "subject_context": models.PayloadSchemaType.KEYWORD,
+    "page_numbers": models.PayloadSchemaType.INTEGER,
+}
 # ---------------------
 
-def index_data():
-    print("🚀 Starting Indexing Pipeline...")
+def chunk_id(chunk):
+    """
+    Stable point ID from source + section + content. Unchanged chunks keep
+    their ID across re-ingests; any edit produces a new one.
+    """
+    key = "\x1f".join([chunk.get("source", ""), chunk.get("section_title", ""), chunk["content"]])
+    return str(uuid.UUID(hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]))
 
-    # 1. Load the Chunks
-    if not os.path.exists(INPUT_FILE):
-        print(f"❌ Error: '{INPUT_FILE}' not found. Run chunking.py first.")
-        return
+def _existing_points(client, sources, collection_name=COLLECTION_NAME, lock=None):
+    """
+    Returns {point_id: payload} for everything already indexed from the
+    given sources ("document", a copy of "content", left out).
+    """
+    existing = {}
+    source_filter = models.Filter(
+        must=[models.FieldCondition(key="source", match=models.MatchAny(any=sorted(sources)))]
+    )
+    offset = None
+    while True:
+        with lock or contextlib.nullcontext():
+            points, offset = client.scroll(
+                collection_name=collection_name,
+                scroll_filter=source_filter,
+                with_payload=models.PayloadSelectorExclude(exclude=["document"]),
+                limit=1000,
+                offset=offset,
+            )
+        for point in points:
+            existing[point.id] = point.payload
+        if offset is None:
+            return existing
+
+def _indexed_contents(client, collection_name=COLLECTION_NAME, lock=None):
+    """
+    Returns {content_digest: point_id} for every point in the collection.
+    One pass over the payloads; vectors are fetched later by ID, only for
+    the matches.
+    """
+    indexed = {}
+    offset = None
+    while True:
+        with lock or contextlib.nullcontext():
+            points, offset = client.scroll(
+                collection_name=collection_name,
+                with_payload=["content"],
+                limit=1000,
+                offset=offset,
+            )
+        for point in points:
+            indexed[content_digest(point.payload.get("content", ""))] = point.id
+        if offset is None:
+            return indexed
+
+def copy_existing_vectors(client, rows, batch_size=UPSERT_BATCH_SIZE, collection_name=COLLECTION_NAME, lock=None,
+                          copied=None):
+    """
+    Passes (point_id, chunk) rows through to embedding, except those whose
+    text is already indexed under another ID (point IDs include the source
+    name, so a renamed document gets new ones). Those are upserted straight
+    away with the existing vectors. copied(n) is called after each upsert.
+    """
+    indexed = None
+    for batch in _batched(rows, batch_size):
+        with span("index.copy_vectors", points=len(batch)) as s:
+            if indexed is None: # Only scanned once there is something new to index
+                indexed = _indexed_contents(client, collection_name, lock)
+            sources = {point_id: indexed.get(content_digest(chunk["content"])) for point_id, chunk in batch}
+            found = {}
+            if any(sources.values()):
+                with lock or contextlib.nullcontext():
+                    matches = client.retrieve(
+                        collection_name=collection_name,
+                        ids=list({match for match in sources.values() if match is not None}),
+                        with_payload=False,
+                        with_vectors=True,
+                    )
+                found = {point.id: point.vector for point in matches}
+            points = [models.PointStruct(id=point_id, vector=found[sources[point_id]],
+                                         payload={"document": chunk["content"], **chunk})
+                      for point_id, chunk in batch if sources[point_id] in found]
+            if points:
+                with lock or contextlib.nullcontext():
+                    client.upsert(collection_name=collection_name, points=points)
+            s.set(copied=len(points))
+        if points:
+            count("index.copied", len(points))
+            print(f"   ♻️ {len(points)} chunks already embedded, vectors copied")
+            if copied:
+                copied(len(points))
+        for point_id, chunk in batch:
+            if sources[point_id] not in found:
+                yield point_id, chunk
+
+def load_embedders(client):
+    """
+    The same dense/sparse FastEmbed models client.add would use.
+    """
+    from fastembed import TextEmbedding, SparseTextEmbedding
+
+    dense = TextEmbedding(model_name=client.embedding_model_name)
+    sparse = None
+    if client.sparse_embedding_model_name:
+        sparse = SparseTextEmbedding(model_name=client.sparse_embedding_model_name)
+    return dense, sparse
+
+def _batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+def embed_and_upsert(client, rows, embedders=None, batch_size=EMBED_BATCH_SIZE, workers=EMBED_WORKERS,
+                     upsert_batch_size=UPSERT_BATCH_SIZE, collection_name=COLLECTION_NAME, lock=None, progress=None):
+    """
+    Streams (point_id, chunk) rows through dense + sparse embedding and
+    upserts every upsert_batch_size points as soon as they are ready, so only
+    one batch of vectors is held in memory. rows can be a generator.
+    Payloads match what client.add would store.
+    Because IDs are content hashes, a crashed run resumes where it stopped:
+    committed batches show up as unchanged on the next run.
+    lock guards writes when the client is shared with other threads;
+    progress(done) is called after every committed batch.
+    """
+    dense_model, sparse_model = embedders or load_embedders(client)
+    dense_name = client.get_vector_field_name()
+    sparse_name = client.get_sparse_vector_field_name()
 
-    with open(INPUT_FILE, "r", encoding="utf-8") as f:
-        chunks = json.load(f)
-    
-    print(f"   Loaded {len(chunks)} semantic chunks.")
+    # Each consumer reads the same single-pass stream; tee only buffers the
+    # few rows the embedders have read ahead.
+    rows, dense_rows, sparse_rows = itertools.tee(rows, 3)
+    dense_vectors = dense_model.embed((chunk["content"] for _, chunk in dense_rows),
+                                      batch_size=batch_size, parallel=workers)
+    if sparse_model is not None:
+        sparse_vectors = sparse_model.embed((chunk["content"] for _, chunk in sparse_rows),
+                                            batch_size=batch_size, parallel=workers)
+    else:
+        sparse_vectors = itertools.repeat(None)
+
+    done = 0
+    start = time.perf_counter()
+    pulled = start
+    for batch in _batched(zip(rows, dense_vectors, sparse_vectors), upsert_batch_size):
+        # Pulling a batch runs the embedders (and, when rows stream straight
+        # from ingest, every stage upstream of them)
+        record("index.embed", time.perf_counter() - pulled, points=len(batch))
+        points = []
+        for (point_id, chunk), dense, sparse in batch:
+            vector = {dense_name: dense.tolist()}
+            if sparse is not None:
+                vector[sparse_name] = models.SparseVector(indices=sparse.indices.tolist(), values=sparse.values.tolist())
+            points.append(models.PointStruct(id=point_id, vector=vector, payload={"document": chunk["content"], **chunk}))
+
+        with span("index.upsert", points=len(points)), lock or contextlib.nullcontext():
+            client.upsert(collection_name=collection_name, points=points)
+        done += len(points)
+        count("index.points", len(points))
+        elapsed = time.perf_counter() - start
+        print(f"   📦 {done} chunks committed ({done / elapsed:.1f} chunks/s)")
+        if progress:
+            progress(done)
+        pulled = time.perf_counter()
+    return done
 
-    # 2. Initialize Qdrant (Local Mode)
+def _ensure_payload_indexes(client, collection_name):
+    """
+    Indexes the fields search_and_rerank filters on, so Qdrant can prune
+    candidates server-side. (Local mode accepts these but doesn't need them.)
+    """
+    for field_name, schema in PAYLOAD_INDEXES.items():
+        client.create_payload_index(collection_name=collection_name, field_name=field_name, field_schema=schema)
+
+def index_chunks(chunks, client=None, embedders=None, batch_size=EMBED_BATCH_SIZE, workers=EMBED_WORKERS,
+                 upsert_batch_size=UPSERT_BATCH_SIZE, collection_name=COLLECTION_NAME, lock=None, progress=None,
+                 reuse_vectors=REUSE_VECTORS):
+    """
+    Syncs chunks from any iterable (a list, or straight from
+    chunking.iter_semantic_chunks) into Qdrant. Pass the Retriever's client
+    (and embedders, and client_lock if it keeps serving queries meanwhile)
+    when running in the same process, since local mode allows one client
+    per path.
+    """
+    guard = lock or contextlib.nullcontext()
+    # 1. Initialize Qdrant (Local Mode)
     # This creates a folder named 'qdrant_db' in your project to store data.
-    client = QdrantClient(path="qdrant_db") 
-    
-    print("   ✅ Qdrant Client initialized (Local mode).")
+    if client is None:
+        client = QdrantClient(path="qdrant_db") 
+        print("   ✅ Qdrant Client initialized (Local mode).")
+    else:
+        print("   ✅ Reusing shared Qdrant Client.")
 
-    # 3. Create Collection (The "Table")
+    # 2. Create Collection (The "Table")
     # We configure it for Hybrid Search (Dense + Sparse)
-    if not client.collection_exists(collection_name=COLLECTION_NAME):
-        print(f"   Creating collection '{COLLECTION_NAME}'...")
-        client.create_collection(
-            collection_name=COLLECTION_NAME,
-            vectors_config=client.get_fastembed_vector_params(), # Auto-configure for BGE-M3
-            sparse_vectors_config=client.get_fastembed_sparse_vector_params(), # Auto-configure for Sparse
-        )
+    if not client.collection_exists(collection_name=collection_name):
+        print(f"   Creating collection '{collection_name}'...")
+        with guard:
+            client.create_collection(
+                collection_name=collection_name,
+                vectors_config=client.get_fastembed_vector_params(), # Auto-configure for BGE-M3
+                sparse_vectors_config=client.get_fastembed_sparse_vector_params(), # Auto-configure for Sparse
+            )
     else:
-        print(f"   Collection '{COLLECTION_NAME}' already exists. Appending data...")
-
-    # 4. Generate Embeddings & Upsert
-    # Qdrant's 'add' method with FastEmbed does the heavy lifting:
-    # It automatically downloads BGE-M3, embeds the text, and uploads it.
-    
-    documents = [chunk["content"] for chunk in chunks]
-    metadata = [chunk for chunk in chunks] # We store the full chunk info as metadata
-    
-    print("   🧠 Generating BGE-M3 vectors (Dense + Sparse)... (This may take time on first run)")
-    
-    client.add(
-        collection_name=COLLECTION_NAME,
-        documents=documents,
-        metadata=metadata,
-        ids=list(range(len(chunks))) # Simple ID 0, 1, 2...
+        print(f"   Collection '{collection_name}' already exists. Syncing changes...")
+
+    # 3. Diff against what is already indexed, one source at a time
+    # Content-addressed IDs mean identical chunks are skipped and edited
+    # chunks show up as one new ID plus one stale ID. Only IDs and small
+    # per-source summaries are kept; the chunks themselves stream through.
+    existing = {}
+    kept = set()
+    new_sections = []
+    refreshed = [] # (point_id, payload) of unchanged chunks whose metadata moved, e.g. to other pages
+    summaries = {}
+
+    def pending():
+        for chunk in chunks:
+            source = chunk.get("source", "")
+            if source not in summaries:
+                with span("index.existing", source=source):
+                    existing.update(_existing_points(client, {source}, collection_name, lock))
+                summaries[source] = {"chunk_count": 0, "pages": set(), "subjects": set(), "fingerprints": set()}
+
+            point_id = chunk_id(chunk)
+            if point_id in kept:
+                continue # Drop exact duplicates
+            kept.add(point_id)
+
+            summary = summaries[source]
+            summary["chunk_count"] += 1
+            # Changes the corpus version on any edit, metadata-only ones included
+            summary["fingerprints"].add(f"{point_id}:{content_digest(json.dumps(chunk, sort_keys=True))}")
+            summary["pages"].update(chunk.get("page_numbers", []))
+            if chunk.get("subject_context"):
+                summary["subjects"].add(chunk["subject_context"])
+
+            if point_id not in existing:
+                new_sections.append((source, chunk.get("section_title")))
+                yield point_id, chunk
+            elif existing[point_id] != chunk:
+                refreshed.append((point_id, {"document": chunk["content"], **chunk}))
+
+    # 4. Generate Embeddings & Upsert (only new or edited chunks)
+    # Chunks stream through FastEmbed in batches and each batch is committed
+    # as soon as it is embedded. We store the full chunk info as metadata.
+    # Text that is already indexed (same document under a new name, or a
+    # section that moved) keeps its vectors instead of being embedded again.
+    committed = {"copied": 0, "embedded": 0}
+
+    def report_progress(copied=0, embedded=None):
+        committed["copied"] += copied
+        if embedded is not None:
+            committed["embedded"] = embedded
+        if progress:
+            progress(committed["copied"] + committed["embedded"])
+
+    rows = pending()
+    if reuse_vectors:
+        rows = copy_existing_vectors(client, rows, upsert_batch_size, collection_name, lock,
+                                     copied=lambda n: report_progress(copied=n))
+
+    print("   🧠 Generating BGE-M3 vectors (Dense + Sparse) for new chunks... (This may take time on first run)")
+    embed_and_upsert(
+        client,
+        rows,
+        embedders=embedders,
+        batch_size=batch_size,
+        workers=workers,
+        upsert_batch_size=upsert_batch_size,
+        collection_name=collection_name,
+        lock=lock,
+        progress=lambda done: report_progress(embedded=done),
     )
 
-    print(f"🎉 SUCCESS! Indexed {len(chunks)} documents into Qdrant.")
+    # 5. Refresh the payload of unchanged chunks whose metadata changed
+    # (same source, section and text, but e.g. new page numbers)
+    if refreshed:
+        with span("index.refresh", points=len(refreshed)):
+            for point_id, payload in refreshed:
+                with guard:
+                    client.overwrite_payload(collection_name=collection_name, payload=payload, points=[point_id])
+
+    # 6. Remove chunks that no longer exist in the source
+    stale_ids = [point_id for point_id in existing if point_id not in kept]
+    if stale_ids:
+        with span("index.delete", points=len(stale_ids)), guard:
+            client.delete(
+                collection_name=collection_name,
+                points_selector=models.PointIdsList(points=stale_ids),
+            )
+
+    stale_sections = {(existing[point_id].get("source"), existing[point_id].get("section_title"))
+                      for point_id in stale_ids}
+    updated = min(sum(1 for key in new_sections if key in stale_sections), len(stale_ids))
+    report = {
+        "added": len(new_sections) - updated,
+        "updated": updated,
+        "removed": len(stale_ids) - updated,
+        "refreshed": len(refreshed),
+        "unchanged": len(kept) - len(new_sections) - len(refreshed),
+    }
+
+    # 7. Payload indexes + corpus registry
+    with guard:
+        _ensure_payload_indexes(client, collection_name)
+    registry = CorpusRegistry()
+    for source, summary in summaries.items():
+        registry.register(source, collection_name, **summary)
+    annotate(**report)
+
+    print(f"🎉 SUCCESS! {report['added']} added, {report['updated']} updated, "
+          f"{report['removed']} removed, {report['refreshed']} refreshed, {report['unchanged']} unchanged.")
     print("   Data is stored in the 'qdrant_db' folder.")
+    return report
+
+def index_data(client=None, embedders=None, batch_size=EMBED_BATCH_SIZE, workers=EMBED_WORKERS,
+               upsert_batch_size=UPSERT_BATCH_SIZE, collection_name=COLLECTION_NAME, input_file=INPUT_FILE):
+    """
+    Embeds semantic_chunks.json (or a .jsonl artifact) into Qdrant.
+    """
+    print("🚀 Starting Indexing Pipeline...")
+
+    # Load the Chunks (streamed when the file is JSON Lines)
+    if not os.path.exists(input_file):
+        print(f"❌ Error: '{input_file}' not found. Run chunking.py first.")
+        return
+
+    with trace("index", file=input_file, collection=collection_name):
+        return index_chunks(
+            read_records(input_file),
+            client=client,
+            embedders=embedders,
+            batch_size=batch_size,
+            workers=workers,
+            upsert_batch_size=upsert_batch_size,
+            collection_name=collection_name,
+        )
 
 if __name__ == "__main__":
-    index_data()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Embed semantic_chunks.json into Qdrant")
+    parser.add_argument("--input", default=INPUT_FILE, help=".json or .jsonl chunks file")
+    parser.add_argument("--batch-size", type=int, default=EMBED_BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=EMBED_WORKERS)
+    parser.add_argument("--upsert-batch-size", type=int, default=UPSERT_BATCH_SIZE)
+    parser.add_argument("--collection", default=COLLECTION_NAME)
+    args = parser.parse_args()
+
+    index_data(batch_size=args.batch_size, workers=args.workers, upsert_batch_size=args.upsert_batch_size,
+               collection_name=args.collection, input_file=args.input)
\ No newline at end of file
@@ -1,98 +1,256 @@
 import os
+import itertools
 import json
+import multiprocessing
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from unstructured.cleaners.core import clean, clean_non_ascii_chars
+from tracing import span, record
 
 # --- CONFIGURATION ---
 INPUT_FILE = "INFORMATION TECHNOLOGY.pdf"  # Update this to your file
 OUTPUT_FILE = "raw_data.json"
+INGEST_WORKERS = os.cpu_count() or 1 # Processes partitioning PDF page ranges in parallel
+PAGES_PER_TASK = 10 # Page range handed to each worker
+RANGES_IN_FLIGHT_PER_WORKER = 2 # Submitted ahead of the consumer; bounds the blocks held in memory
+FAST_TEXT_PAGES = False # Use the cheap "fast" strategy on pages that already have a text layer
+MIN_TEXT_LAYER_CHARS = 200 # Extractable characters for a page to count as having a text layer
 # ---------------------
 
-def load_and_structure_file(file_path):
+def _element_to_block(element, source_name, page_offset=0):
+    """
+    Cleans one unstructured element into our block format, or returns None
+    if it should be skipped.
+    """
+    # Safety check
+    if not hasattr(element, "text") or not element.text:
+        return None
+
+    # 1. STOP REMOVING HEADERS
+    # In this PDF, "Semester 3" or "Subject Name" might be a Header. We need them.
+    # We only skip 'Footer' (page numbers) to avoid noise.
+    if element.category == "Footer":
+        return None
+
+    # 2. LIGHTER CLEANING
+    # Don't lowercase or remove bullets aggressively
+    text = clean(element.text, extra_whitespace=True, dashes=True, bullets=False)
+    text = clean_non_ascii_chars(text)
+
+    # 3. STOP REMOVING SHORT TEXT
+    # Syllabus codes like "CO1" or "Unit 1" are short but vital.
+    if len(text) < 2:
+        return None
+
+    # 4. HANDLE TABLES
+    # If it's a table, we want to flag it or just treat it as text
+    elem_type = element.category
+    if elem_type == "Table":
+        text = "[TABLE DATA] " + text
+
+    # Save Safe Metadata
+    page_num = getattr(element.metadata, "page_number", 1) if hasattr(element, "metadata") else 1
+    page_num = (page_num or 1) + page_offset
+
+    return {
+        "type": elem_type,
+        "text": text,
+        "metadata": {"source": source_name, "page": page_num}
+    }
+
+def _partition_pdf_file(path, strategy):
+    from unstructured.partition.pdf import partition_pdf
+
+    if strategy == "hi_res":
+        # CRITICAL UPDATE: infer_table_structure=True forces it to look inside tables
+        return partition_pdf(
+            filename=path,
+            strategy="hi_res",
+            infer_table_structure=True,
+            chunking_strategy="by_title" # This helps keep related text together
+        )
+    return partition_pdf(filename=path, strategy=strategy, chunking_strategy="by_title")
+
+def _partition_page_range(file_path, source_name, start, end, strategy):
+    """
+    Worker: partitions pages [start, end) of a PDF and returns cleaned blocks
+    with page numbers relative to the full document.
+    """
+    from pypdf import PdfReader, PdfWriter
+
+    reader = PdfReader(file_path)
+    writer = PdfWriter()
+    for page in reader.pages[start:end]:
+        writer.add_page(page)
+
+    fd, range_path = tempfile.mkstemp(suffix=".pdf")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            writer.write(f)
+        elements = _partition_pdf_file(range_path, strategy)
+    finally:
+        os.remove(range_path)
+
+    blocks = []
+    for element in elements:
+        block = _element_to_block(element, source_name, page_offset=start)
+        if block:
+            blocks.append(block)
+    return blocks
+
+def _timed_partition_page_range(*args):
+    """
+    Worker: _partition_page_range plus its duration, since spans opened in
+    a worker process never reach the parent's trace.
+    """
+    start = time.perf_counter()
+    blocks = _partition_page_range(*args)
+    return blocks, time.perf_counter() - start
+
+def plan_page_ranges(file_path, pages_per_task=PAGES_PER_TASK, fast_text_pages=FAST_TEXT_PAGES):
+    """
+    Splits a PDF into [(start, end, strategy), ...]. With fast_text_pages,
+    runs of pages that have a real text layer use "fast" and scanned pages
+    keep hi_res; ranges never mix strategies.
+    """
+    from pypdf import PdfReader
+
+    reader = PdfReader(str(file_path))
+    strategies = []
+    for page in reader.pages:
+        strategy = "hi_res"
+        if fast_text_pages and len((page.extract_text() or "").strip()) >= MIN_TEXT_LAYER_CHARS:
+            strategy = "fast"
+        strategies.append(strategy)
+
+    ranges = []
+    start = 0
+    for i in range(1, len(strategies) + 1):
+        if i == len(strategies) or strategies[i] != strategies[start] or i - start == pages_per_task:
+            ranges.append((start, i, strategies[start]))
+            start = i
+    return ranges
+
+def _iter_pdf_blocks(file_path, workers=INGEST_WORKERS, pages_per_task=PAGES_PER_TASK,
+                     fast_text_pages=FAST_TEXT_PAGES):
+    ranges = plan_page_ranges(file_path, pages_per_task, fast_text_pages)
+    pages = ranges[-1][1] if ranges else 0
+    fast = sum(end - start for start, end, strategy in ranges if strategy == "fast")
+    print(f"   👉 Using PDF Partitioner: {pages} pages in {len(ranges)} ranges, "
+          f"{workers} workers ({pages - fast} hi_res + Tables, {fast} fast)...")
+
+    # Always by page range, even in-process: by_title restarts at each range
+    # boundary, so the blocks (and the ingestion cache) mustn't depend on the
+    # number of workers
+    if workers <= 1 or len(ranges) <= 1:
+        for start, end, strategy in ranges:
+            with span("ingest.partition", pages=end - start, strategy=strategy):
+                blocks = _partition_page_range(str(file_path), file_path.name, start, end, strategy)
+            yield from blocks
+        return
+
+    # Spawned workers, since this may run inside a process that already has
+    # threads and torch loaded (a JobQueue worker or the app itself)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        pending = iter(ranges)
+        in_flight = deque()
+
+        def submit_next():
+            for start, end, strategy in itertools.islice(pending, 1):
+                future = pool.submit(_timed_partition_page_range, str(file_path), file_path.name, start, end, strategy)
+                in_flight.append((future, start, end, strategy))
+
+        # Only a few ranges ahead of the consumer, so finished ranges don't
+        # pile up in memory while an earlier one is still being partitioned
+        for _ in range(workers * RANGES_IN_FLIGHT_PER_WORKER):
+            submit_next()
+        # Yield in page order, as soon as each range (and all before it) is done
+        while in_flight:
+            future, start, end, strategy = in_flight.popleft()
+            with span("ingest.wait", pages=end - start):
+                blocks, seconds = future.result()
+            submit_next()
+            record("ingest.partition", seconds, pages=end - start, strategy=strategy, worker=True)
+            yield from blocks
+
+def iter_structured_blocks(file_path, workers=INGEST_WORKERS, pages_per_task=PAGES_PER_TASK,
+                           fast_text_pages=FAST_TEXT_PAGES, strict=False):
+    """
+    Yields cleaned blocks one at a time, so downstream stages can start
+    before the whole document has been turned into a list. PDFs are
+    partitioned in page ranges across a process pool.
+    With strict=True partition errors are raised instead of ending the
+    stream early, so a truncated document can't be mistaken for a full one.
+    """
     file_path = Path(file_path)
     file_ext = file_path.suffix.lower()
-    
+
     print(f"🔄 Processing: {file_path.name}...")
-    
+
+    if file_ext == ".pdf":
+        try:
+            yield from _iter_pdf_blocks(file_path, workers, pages_per_task, fast_text_pages)
+        except Exception as e:
+            if strict:
+                raise
+            print(f"❌ Error during partition: {e}")
+        return
+
     elements = []
     try:
-        if file_ext == ".pdf":
-            from unstructured.partition.pdf import partition_pdf
-            print("   👉 Using PDF Partitioner (hi_res + Tables)...")
-            # CRITICAL UPDATE: infer_table_structure=True forces it to look inside tables
-            elements = partition_pdf(
-                filename=str(file_path), 
-                strategy="hi_res", 
-                infer_table_structure=True,
-                chunking_strategy="by_title" # This helps keep related text together
-            )
-        elif file_ext == ".txt":
-            from unstructured.partition.text import partition_text
-            elements = partition_text(filename=str(file_path))
-        elif file_ext == ".docx":
-            from unstructured.partition.docx import partition_docx
-            elements = partition_docx(filename=str(file_path))
-
-        # [NEW] Image Support
-        elif file_ext in [".jpg", ".jpeg", ".png"]:
-            from unstructured.partition.image import partition_image
-            print("   👉 Using Image Partitioner (OCR)...")
-            elements = partition_image(filename=str(file_path))
+        with span("ingest.partition", format=file_ext):
+            if file_ext == ".txt":
+                from unstructured.partition.text import partition_text
+                elements = partition_text(filename=str(file_path))
+            elif file_ext == ".docx":
+                from unstructured.partition.docx import partition_docx
+                elements = partition_docx(filename=str(file_path))
 
-        else:
-            print(f"❌ Unsupported format: {file_ext}")
-            return []
+            # [NEW] Image Support
+            elif file_ext in [".jpg", ".jpeg", ".png"]:
+                from unstructured.partition.image import partition_image
+                print("   👉 Using Image Partitioner (OCR)...")
+                elements = partition_image(filename=str(file_path))
+
+            else:
+                print(f"❌ Unsupported format: {file_ext}")
+                return
 
     except Exception as e:
+        if strict:
+            raise
         print(f"❌ Error during partition: {e}")
-        return []
+        return
 
     print(f"   📊 Raw elements found: {len(elements)}")
 
-    structured_blocks = []
     for element in elements:
-        # Safety check
-        if not hasattr(element, "text") or not element.text: 
-            continue
-
-        # 1. STOP REMOVING HEADERS
-        # In this PDF, "Semester 3" or "Subject Name" might be a Header. We need them.
-        # We only skip 'Footer' (page numbers) to avoid noise.
-        if element.category == "Footer": 
-            continue 
-
-        # 2. LIGHTER CLEANING
-        # Don't lowercase or remove bullets aggressively
-        text = clean(element.text, extra_whitespace=True, dashes=True, bullets=False)
-        text = clean_non_ascii_chars(text)
-
-        # 3. STOP REMOVING SHORT TEXT
-        # Syllabus codes like "CO1" or "Unit 1" are short but vital.
-        if len(text) < 2: 
-            continue
-
-        # 4. HANDLE TABLES
-        # If it's a table, we want to flag it or just treat it as text
-        elem_type = element.category
-        if elem_type == "Table":
-            text = "[TABLE DATA] " + text
-
-        # Save Safe Metadata
-        page_num = getattr(element.metadata, "page_number", 1) if hasattr(element, "metadata") else 1
-
-        block = {
-            "type": elem_type,
-            "text": text,
-            "metadata": {"source": file_path.name, "page": page_num}
-        }
-        structured_blocks.append(block)
-
-    return structured_blocks
+        block = _element_to_block(element, file_path.name)
+        if block:
+            yield block
+
+def ingest_settings(pages_per_task=PAGES_PER_TASK, fast_text_pages=FAST_TEXT_PAGES):
+    """
+    Everything besides the file bytes that changes the extracted blocks.
+    Part of the ingestion cache key.
+    """
+    return {
+        "pages_per_task": pages_per_task,
+        "fast_text_pages": fast_text_pages,
+        "min_text_layer_chars": MIN_TEXT_LAYER_CHARS,
+        "partition": "page_ranges", # Blocks cached before every PDF was split by range may differ
+    }
+
+def load_and_structure_file(file_path, **kwargs):
+    return list(iter_structured_blocks(file_path, **kwargs))
 
 if __name__ == "__main__":
     if os.path.exists(INPUT_FILE):
         blocks = load_and_structure_file(INPUT_FILE)
-        
+
         if blocks:
             with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
                 json.dump(blocks, f, indent=2, ensure_ascii=False)
@@ -100,4 +258,4 @@ if __name__ == "__main__":
         else:
             print("❌ No text extracted.")
     else:
-        print(f"❌ File '{INPUT_FILE}' not found.")
\ No newline at end of file
+        print(f"❌ File '{INPUT_FILE}' not found.")
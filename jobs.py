@@ -0,0 +1,154 @@
+import json
+import multiprocessing
+import os
+import queue
+import shutil
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from artifacts import read_records
+from ingest import INGEST_WORKERS
+from index import index_chunks, COLLECTION_NAME
+from tracing import trace
+
+# --- CONFIGURATION ---
+JOBS_DIR = "jobs" # One folder per job: the uploaded file and its chunks.jsonl
+INGEST_PROCESSES = 2 # Documents ingested at the same time
+KEEP_JOB_FILES = False # Keep a finished job's folder for debugging
+# ---------------------
+
+def _prepare_chunks(job_id, file_path, chunks_path, progress, workers):
+    """
+    Worker process: ingest + chunk one document into its own chunks.jsonl.
+    Runs outside the app process so OCR never blocks the UI.
+    """
+    from pipeline import iter_document_chunks
+
+    progress[job_id] = {"stage": "ingesting", "chunks": 0}
+    count = 0
+    with trace("ingest_job", job=job_id, file=os.path.basename(file_path)), \
+            open(chunks_path, "w", encoding="utf-8") as f:
+        for chunk in iter_document_chunks(file_path, workers=workers):
+            f.write(json.dumps(chunk, ensure_ascii=False, separators=(",", ":")))
+            f.write("\n")
+            count += 1
+            if count % 10 == 0:
+                progress[job_id] = {"stage": "chunking", "chunks": count}
+    progress[job_id] = {"stage": "chunked", "chunks": count}
+    return count
+
+class JobQueue:
+    """
+    Background ingestion for the Streamlit app. Ingest + chunking run in a
+    process pool, each job in its own folder. Indexing runs on a single
+    thread in this process, because local Qdrant allows one client per
+    folder: it reuses the Retriever's client and takes its client_lock per
+    write, so chat keeps working while documents are processed.
+    """
+
+    def __init__(self, client=None, embedders=None, client_lock=None, on_indexed=None,
+                 collection_name=COLLECTION_NAME, processes=INGEST_PROCESSES, jobs_dir=JOBS_DIR):
+        self.client = client
+        self.embedders = embedders
+        self.client_lock = client_lock
+        self.on_indexed = on_indexed
+        self.collection_name = collection_name
+        self.jobs_dir = jobs_dir
+        # Split the CPUs between concurrent documents instead of oversubscribing
+        self.ingest_workers = max(1, INGEST_WORKERS // processes)
+
+        # Spawn, not fork: this process already runs torch/ONNX and several
+        # threads, and forking it can deadlock the child
+        context = multiprocessing.get_context("spawn")
+        self._manager = context.Manager()
+        self._progress = self._manager.dict()
+        self._pool = ProcessPoolExecutor(max_workers=processes, mp_context=context)
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._to_index = queue.Queue()
+        threading.Thread(target=self._index_loop, name="indexing", daemon=True).start()
+
+    def submit(self, file_name, data):
+        """
+        Queues an uploaded file. Returns its job id immediately.
+        """
+        job_id = uuid.uuid4().hex[:12]
+        job_dir = os.path.join(self.jobs_dir, job_id)
+        os.makedirs(job_dir)
+        file_path = os.path.join(job_dir, os.path.basename(file_name))
+        with open(file_path, "wb") as f:
+            f.write(data)
+
+        with self._lock:
+            self._jobs[job_id] = {
+                "id": job_id,
+                "file": os.path.basename(file_name),
+                "stage": "queued",
+                "chunks": 0,
+                "indexed": 0,
+                "report": None,
+                "error": None,
+                "submitted_at": time.time(),
+                "finished_at": None,
+            }
+
+        chunks_path = os.path.join(job_dir, "chunks.jsonl")
+        future = self._pool.submit(_prepare_chunks, job_id, file_path, chunks_path, self._progress, self.ingest_workers)
+        future.add_done_callback(lambda f: self._chunked(job_id, chunks_path, f))
+        return job_id
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            self._jobs[job_id].update(fields)
+
+    def _chunked(self, job_id, chunks_path, future):
+        try:
+            self._update(job_id, stage="waiting to index", chunks=future.result())
+            self._to_index.put((job_id, chunks_path))
+        except Exception as e:
+            self._finish(job_id, error=f"Ingestion failed: {e}")
+
+    def _index_loop(self):
+        while True:
+            job_id, chunks_path = self._to_index.get()
+            self._update(job_id, stage="indexing")
+            try:
+                with trace("index_job", job=job_id):
+                    report = index_chunks(
+                        read_records(chunks_path),
+                        client=self.client,
+                        embedders=self.embedders,
+                        collection_name=self.collection_name,
+                        lock=self.client_lock,
+                        progress=lambda done: self._update(job_id, indexed=done),
+                    )
+                if self.on_indexed:
+                    self.on_indexed()
+                self._finish(job_id, report=report)
+            except Exception as e:
+                traceback.print_exc()
+                self._finish(job_id, error=f"Indexing failed: {e}")
+
+    def _finish(self, job_id, report=None, error=None):
+        self._update(job_id, stage="failed" if error else "done", report=report, error=error, finished_at=time.time())
+        self._progress.pop(job_id, None)
+        if not KEEP_JOB_FILES:
+            shutil.rmtree(os.path.join(self.jobs_dir, job_id), ignore_errors=True)
+
+    def status(self, job_id):
+        with self._lock:
+            job = dict(self._jobs[job_id])
+        # Worker processes report ingest/chunking progress through the manager
+        if job["stage"] == "queued" and job_id in self._progress:
+            job.update(self._progress[job_id])
+        return job
+
+    def jobs(self):
+        """
+        Snapshot of every job, newest first.
+        """
+        with self._lock:
+            ids = sorted(self._jobs, key=lambda i: self._jobs[i]["submitted_at"], reverse=True)
+        return [self.status(job_id) for job_id in ids]
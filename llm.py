@@ -0,0 +1,255 @@
+import json
+import os
+import random
+import threading
+import time
+import httpx
+from dotenv import load_dotenv
+from tracing import span
+
+load_dotenv()
+
+# --- CONFIGURATION ---
+LLM_BACKEND = "groq" # "groq" (Groq SDK) or "openai" (any OpenAI-compatible server over plain HTTP)
+API_KEY = os.getenv("GROQ_API_KEY")
+BASE_URL = os.getenv("GROQ_BASE_URL") # None = Groq cloud; e.g. fake_llm.py's address for offline runs
+MAX_CONCURRENT_REQUESTS = 8 # LLM calls in flight per process; the rest wait for a slot
+MAX_CONNECTIONS = 16 # HTTP connections kept in the shared pool
+REQUEST_TIMEOUT = 60.0 # Seconds per call (waiting for a slot included) unless the caller passes its own
+CONNECT_TIMEOUT = 5.0
+MAX_RETRIES = 3 # Retries for timeouts, connection errors, 429 and 5xx
+RETRY_BASE_DELAY = 0.5 # Seconds; doubles per attempt, with full jitter
+RETRY_MAX_DELAY = 8.0
+# ---------------------
+
+def _http_client(timeout=REQUEST_TIMEOUT, max_connections=MAX_CONNECTIONS, **kwargs):
+    """
+    One keep-alive connection pool shared by every call in the process.
+    """
+    return httpx.Client(
+        timeout=httpx.Timeout(timeout, connect=CONNECT_TIMEOUT),
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        **kwargs,
+    )
+
+def _retry_after(response):
+    # Servers send Retry-After (seconds) with 429s
+    try:
+        return float(response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+class GroqBackend:
+    """
+    Groq SDK on a shared httpx pool. The SDK's own retries are disabled so
+    LLMClient's backoff and concurrency limit apply to every call.
+    """
+
+    def __init__(self, api_key=API_KEY, base_url=BASE_URL, timeout=REQUEST_TIMEOUT, max_connections=MAX_CONNECTIONS):
+        import groq
+
+        self.errors = groq
+        self.client = groq.Groq(
+            api_key=api_key,
+            base_url=base_url,
+            max_retries=0,
+            timeout=timeout,
+            http_client=_http_client(timeout, max_connections),
+        )
+
+    def complete(self, messages, model, timeout, **params):
+        completion = self.client.chat.completions.create(messages=messages, model=model, timeout=timeout, **params)
+        return completion.choices[0].message.content
+
+    def stream(self, messages, model, timeout, **params):
+        stream = self.client.chat.completions.create(messages=messages, model=model, timeout=timeout,
+                                                     stream=True, **params)
+        try:
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            stream.close() # Hands the connection back to the pool even if the caller stops early
+
+    def retry_delay(self, error):
+        """
+        None if the error isn't worth retrying, else the server's requested
+        wait (0.0 when it didn't ask for one).
+        """
+        retryable = (self.errors.APIConnectionError, self.errors.RateLimitError, self.errors.InternalServerError)
+        if not isinstance(error, retryable):
+            return None
+        return _retry_after(getattr(error, "response", None)) or 0.0
+
+class OpenAICompatibleBackend:
+    """
+    Plain HTTP client for any OpenAI-compatible /chat/completions endpoint
+    (vLLM, Ollama, fake_llm.py, ...). base_url includes the API prefix,
+    e.g. "http://127.0.0.1:8001/openai/v1".
+    """
+
+    def __init__(self, api_key=API_KEY, base_url=BASE_URL, timeout=REQUEST_TIMEOUT, max_connections=MAX_CONNECTIONS):
+        if not base_url:
+            raise ValueError("The openai backend needs a base_url")
+        headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        self.http = _http_client(timeout, max_connections, base_url=base_url, headers=headers)
+
+    def complete(self, messages, model, timeout, **params):
+        response = self.http.post("/chat/completions", json={"messages": messages, "model": model, **params},
+                                  timeout=timeout)
+        response.raise_for_status()
+        return response.json()["choices"][0]["message"]["content"]
+
+    def stream(self, messages, model, timeout, **params):
+        body = {"messages": messages, "model": model, "stream": True, **params}
+        with self.http.stream("POST", "/chat/completions", json=body, timeout=timeout) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                choices = json.loads(data).get("choices") or [{}]
+                text = choices[0].get("delta", {}).get("content")
+                if text:
+                    yield text
+
+    def retry_delay(self, error):
+        if isinstance(error, httpx.TransportError): # Includes timeouts
+            return 0.0
+        if isinstance(error, httpx.HTTPStatusError):
+            status = error.response.status_code
+            if status == 429 or status >= 500:
+                return _retry_after(error.response) or 0.0
+        return None
+
+LLM_BACKENDS = {
+    "groq": GroqBackend,
+    "openai": OpenAICompatibleBackend,
+}
+
+class LLMClient:
+    """
+    The one way this app talks to an LLM. Every call goes through a shared
+    connection pool, at most max_concurrent calls run at once, and
+    transient failures are retried with exponential backoff and jitter.
+    """
+
+    def __init__(self, backend=None, max_concurrent=MAX_CONCURRENT_REQUESTS, max_retries=MAX_RETRIES,
+                 timeout=REQUEST_TIMEOUT):
+        self.backend = backend if backend is not None else load_backend()
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._stats_lock = threading.Lock()
+        self._stats = {"requests": 0, "retries": 0, "errors": 0, "in_flight": 0, "wait_ms": 0.0}
+
+    def _count(self, **deltas):
+        with self._stats_lock:
+            for key, delta in deltas.items():
+                self._stats[key] += delta
+
+    def _acquire(self, timeout):
+        """
+        Waits up to timeout seconds for a free slot. Returns the milliseconds
+        spent waiting, or raises TimeoutError when every slot stayed busy.
+        """
+        start = time.perf_counter()
+        if not self._slots.acquire(timeout=timeout):
+            self._count(errors=1)
+            raise TimeoutError(f"No free LLM slot within {timeout:.1f}s")
+        waited = (time.perf_counter() - start) * 1000
+        self._count(requests=1, in_flight=1, wait_ms=waited)
+        return waited
+
+    def _release(self):
+        self._count(in_flight=-1)
+        self._slots.release()
+
+    def _backoff(self, attempt, error, retries):
+        """
+        Sleeps before the next attempt, or re-raises when the error isn't
+        retryable or retries are used up.
+        """
+        delay = self.backend.retry_delay(error)
+        if delay is None or attempt >= retries:
+            self._count(errors=1)
+            raise error
+        # Full jitter keeps concurrent callers from retrying in lockstep
+        delay = max(delay, random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)))
+        print(f"   🔁 LLM call failed ({type(error).__name__}), retrying in {delay:.2f}s...")
+        self._count(retries=1)
+        time.sleep(delay)
+
+    def complete(self, messages, model, timeout=None, retries=None, **params):
+        """
+        Returns the whole completion text.
+        """
+        retries = self.max_retries if retries is None else retries
+        timeout = timeout or self.timeout
+        attempt = 0
+        with span("llm.complete", model=model) as s:
+            while True:
+                waited = self._acquire(timeout)
+                s.set(attempts=attempt + 1, slot_wait_ms=round(waited, 3))
+                try:
+                    return self.backend.complete(messages, model, timeout - waited / 1000, **params)
+                except Exception as e:
+                    error = e
+                finally:
+                    self._release()
+                self._backoff(attempt, error, retries)
+                attempt += 1
+
+    def stream(self, messages, model, timeout=None, retries=None, **params):
+        """
+        Yields completion text as it arrives. A failure before the first
+        token is retried; once text has been yielded it is raised, since the
+        caller has already shown part of the answer.
+        """
+        retries = self.max_retries if retries is None else retries
+        timeout = timeout or self.timeout
+        attempt = 0
+        with span("llm.stream", model=model) as s:
+            while True:
+                started = False
+                waited = self._acquire(timeout)
+                s.set(attempts=attempt + 1, slot_wait_ms=round(waited, 3))
+                try:
+                    for text in self.backend.stream(messages, model, timeout - waited / 1000, **params):
+                        started = True
+                        yield text
+                    return
+                except Exception as e:
+                    if started:
+                        self._count(errors=1)
+                        raise
+                    error = e
+                finally:
+                    self._release()
+                self._backoff(attempt, error, retries)
+                attempt += 1
+
+    def stats(self):
+        with self._stats_lock:
+            return dict(self._stats)
+
+def load_backend(name=LLM_BACKEND, **kwargs):
+    if name not in LLM_BACKENDS:
+        raise ValueError(f"Unknown LLM backend: {name}")
+    return LLM_BACKENDS[name](**kwargs)
+
+_llm = None
+_llm_lock = threading.Lock()
+
+def get_llm():
+    """
+    Process-wide LLMClient, created on first use and shared by query
+    expansion, generate.py and the Streamlit app.
+    """
+    global _llm
+    with _llm_lock:
+        if _llm is None:
+            _llm = LLMClient()
+        return _llm
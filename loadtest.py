@@ -0,0 +1,286 @@
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from tracing import Trace, trace
+
+try:
+    import psutil
+except ImportError: # Optional: CPU still comes from process_time, memory from resource where available
+    psutil = None
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+# --- CONFIGURATION ---
+QUESTIONS_FILE = "eval_questions.json" # Falls back to benchmark.SAMPLE_QUERIES when missing
+RESULTS_FILE = "loadtest_results.json"
+DURATION = 30.0 # Seconds per load level
+MAX_IN_FLIGHT = 64 # Open-loop mode: requests running at once before new arrivals queue
+SAMPLE_INTERVAL = 0.5 # Seconds between memory samples (psutil only)
+FAKE_FIRST_TOKEN_DELAY = 0.3
+FAKE_TOKEN_DELAY = 0.01
+# ---------------------
+
+def load_questions(path=QUESTIONS_FILE):
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            return [q["question"] for q in json.load(f)]
+    from benchmark import SAMPLE_QUERIES
+    return list(SAMPLE_QUERIES)
+
+class ResourceMonitor:
+    """
+    CPU and memory of this process while one load level runs. CPU is
+    process_time over wall time, i.e. how many cores were kept busy.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.report = {}
+
+    def _sample(self):
+        process = psutil.Process()
+        while not self._stop.wait(self.interval):
+            self._rss.append(process.memory_info().rss)
+
+    def __enter__(self):
+        self._rss = []
+        self._stop = threading.Event()
+        self._thread = None
+        if psutil is not None:
+            self._thread = threading.Thread(target=self._sample, name="resource-monitor", daemon=True)
+            self._thread.start()
+        self._cpu = time.process_time()
+        self._wall = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        cpu = time.process_time() - self._cpu
+        wall = time.perf_counter() - self._wall
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+        self.report = {"cpu_cores": round(cpu / wall, 2) if wall else 0.0, "cpu_count": os.cpu_count()}
+        if self._rss:
+            self.report["rss_mb_peak"] = round(max(self._rss) / 2**20, 1)
+            self.report["rss_mb_mean"] = round(sum(self._rss) / len(self._rss) / 2**20, 1)
+        elif resource is not None:
+            # Peak over the whole process lifetime; KB on Linux, bytes on macOS
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            self.report["rss_mb_peak"] = round(peak / (2**20 if sys.platform == "darwin" else 2**10), 1)
+        return False
+
+def make_request(target, expand=False):
+    """
+    Returns ask(question) -> (trace, error) for the chosen entry point.
+    """
+    if target == "retrieve":
+        from retrieve import search_and_rerank
+        call = lambda question: search_and_rerank(question, expand=expand)
+    else:
+        from generate import generate_answer
+        call = lambda question: generate_answer(question, expand=expand)
+
+    def ask(question):
+        error = None
+        with trace("load", target=target) as request_trace:
+            try:
+                call(question)
+            except Exception as e:
+                error = type(e).__name__
+        return request_trace, error
+    return ask
+
+def run_closed(ask, questions, concurrency, duration=DURATION, max_requests=None):
+    """
+    Closed loop: `concurrency` users, each asking its next question as soon
+    as the previous answer arrives.
+    """
+    results = []
+    ids = itertools.count()
+    stop_at = time.perf_counter() + duration
+
+    def user():
+        while time.perf_counter() < stop_at:
+            i = next(ids)
+            if max_requests is not None and i >= max_requests:
+                return
+            start = time.perf_counter()
+            request_trace, error = ask(questions[i % len(questions)])
+            results.append({"ms": (time.perf_counter() - start) * 1000, "error": error, "trace": request_trace})
+
+    threads = [threading.Thread(target=user, name=f"user-{n}") for n in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def run_open(ask, questions, rate, duration=DURATION, max_in_flight=MAX_IN_FLIGHT, seed=0):
+    """
+    Open loop: Poisson arrivals at `rate` questions/s, whether or not earlier
+    ones have finished. Latency counts from the arrival, so time spent
+    queued behind a saturated pipeline shows up in it.
+    """
+    rng = random.Random(seed)
+    results = []
+
+    def timed(question, arrived):
+        request_trace, error = ask(question)
+        results.append({"ms": (time.perf_counter() - arrived) * 1000, "error": error, "trace": request_trace})
+
+    with ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="arrival") as pool:
+        start = time.perf_counter()
+        arrival = start
+        for i in itertools.count():
+            if arrival >= start + duration:
+                break
+            time.sleep(max(0.0, arrival - time.perf_counter()))
+            pool.submit(timed, questions[i % len(questions)], arrival)
+            arrival += rng.expovariate(rate)
+    return results
+
+def summarize(results, wall_s, resources):
+    from evaluate import percentile
+
+    ok = [r for r in results if r["error"] is None]
+    latencies = [r["ms"] for r in ok]
+    summary = {
+        "requests": len(results),
+        "errors": len(results) - len(ok),
+        "throughput": round(len(ok) / wall_s, 2),
+        "latency_ms": {f"p{p}": round(percentile(latencies, p), 1) for p in (50, 90, 95, 99)} if latencies else {},
+        "resources": resources,
+    }
+    if latencies:
+        summary["latency_ms"]["max"] = round(max(latencies), 1)
+
+    # Where requests wait: per-stage time, plus contention on the Qdrant
+    # client lock and on the LLM client's concurrency slots
+    stages = {}
+    waits = {"qdrant_lock_wait_ms": [], "llm_slot_wait_ms": [], "ttft_ms": []}
+    for r in ok:
+        if not isinstance(r["trace"], Trace):
+            continue
+        for s in r["trace"].spans:
+            stages.setdefault(s["name"], []).append(s["duration_ms"])
+            if "lock_wait_ms" in s:
+                waits["qdrant_lock_wait_ms"].append(s["lock_wait_ms"])
+            if "slot_wait_ms" in s:
+                waits["llm_slot_wait_ms"].append(s["slot_wait_ms"])
+        if "ttft_ms" in r["trace"].attrs:
+            waits["ttft_ms"].append(r["trace"].attrs["ttft_ms"])
+    summary["stages_ms"] = {name: {"p50": round(percentile(v, 50), 1), "p95": round(percentile(v, 95), 1)}
+                            for name, v in sorted(stages.items())}
+    summary["waits_ms"] = {name: {"p50": round(percentile(v, 50), 1), "p95": round(percentile(v, 95), 1)}
+                           for name, v in waits.items() if v}
+    return summary
+
+def _disable_caches(retriever):
+    # Replayed questions would otherwise be answered from cache after the first round
+    import retrieve
+    import generate
+    from cache import LRUCache
+
+    retrieve._expansion_cache = LRUCache(max_size=0)
+    generate.ANSWER_CACHE_ENABLED = False
+    retriever.score_cache = None
+
+def print_levels(levels, mode):
+    print(f"\n📊 Load test ({mode})")
+    print(f"{'level':>6} | {'ok':>5} | {'err':>4} | {'req/s':>6} | {'p50 ms':>8} | {'p95 ms':>8} | {'p99 ms':>8} | "
+          f"{'cores':>5} | {'RSS MB':>7} | {'lock p95':>8} | {'slot p95':>8} | {'TTFT p50':>8}")
+    print("-" * 112)
+    for level in levels:
+        latency = level["latency_ms"]
+        waits = level["waits_ms"]
+        wait = lambda name, p: f"{waits[name][p]:.0f}" if name in waits else "-"
+        print(f"{level['level']:>6} | {level['requests'] - level['errors']:>5} | {level['errors']:>4} | "
+              f"{level['throughput']:>6.2f} | {latency.get('p50', 0):>8.0f} | {latency.get('p95', 0):>8.0f} | "
+              f"{latency.get('p99', 0):>8.0f} | {level['resources']['cpu_cores']:>5.2f} | "
+              f"{level['resources'].get('rss_mb_peak', '-'):>7} | {wait('qdrant_lock_wait_ms', 'p95'):>8} | "
+              f"{wait('llm_slot_wait_ms', 'p95'):>8} | {wait('ttft_ms', 'p50'):>8}")
+        if "rerank_batches" in level:
+            batches = level["rerank_batches"]
+            print(f"{'':>6}   🧺 {batches['batches']} rerank batches, {batches['mean_pairs']} pairs / "
+                  f"{batches['mean_requests']} questions each")
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay questions against retrieval or generation under concurrent load")
+    parser.add_argument("--target", choices=["retrieve", "answer"], default="answer")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8], help="Closed-loop users per level")
+    parser.add_argument("--rate", type=float, nargs="+", help="Open-loop arrivals/s per level (instead of --concurrency)")
+    parser.add_argument("--duration", type=float, default=DURATION, help="Seconds per level")
+    parser.add_argument("--requests", type=int, help="Closed loop: stop a level after this many questions")
+    parser.add_argument("--questions", default=QUESTIONS_FILE)
+    parser.add_argument("--expand", action="store_true", help="Include query expansion in retrieval")
+    parser.add_argument("--keep-caches", action="store_true", help="Leave the expansion, score and answer caches on")
+    parser.add_argument("--real-llm", action="store_true", help="Use the LLM configured in llm.py instead of a fake one")
+    parser.add_argument("--first-token-delay", type=float, default=FAKE_FIRST_TOKEN_DELAY)
+    parser.add_argument("--token-delay", type=float, default=FAKE_TOKEN_DELAY)
+    parser.add_argument("--cold", action="store_true", help="Skip the warm-up, so the first requests load the models")
+    parser.add_argument("--output", default=RESULTS_FILE)
+    args = parser.parse_args()
+
+    if not args.real_llm:
+        from fake_llm import start_in_background
+        start_in_background(first_token_delay=args.first_token_delay, token_delay=args.token_delay)
+    from retrieve import get_retriever
+
+    questions = load_questions(args.questions)
+    retriever = get_retriever()
+    start = time.perf_counter()
+    if not args.cold:
+        retriever.warm_up()
+    startup_s = time.perf_counter() - start
+    if not args.keep_caches:
+        _disable_caches(retriever)
+    ask = make_request(args.target, expand=args.expand)
+
+    mode = "open loop, arrivals/s" if args.rate else "closed loop, users"
+    levels = []
+    for level in args.rate or args.concurrency:
+        print(f"\n🚦 {args.target}: {level} {'arrivals/s' if args.rate else 'users'} for {args.duration:.0f}s...")
+        batching = getattr(retriever.reranker, "stats", None) # BatchingReranker only
+        before = batching() if batching else None
+        with ResourceMonitor() as monitor:
+            start = time.perf_counter()
+            if args.rate:
+                results = run_open(ask, questions, level, args.duration)
+            else:
+                results = run_closed(ask, questions, level, args.duration, args.requests)
+            wall_s = time.perf_counter() - start
+        levels.append({"level": level, **summarize(results, wall_s, monitor.report)})
+        if batching:
+            after = batching()
+            batches = after["batches"] - before["batches"]
+            levels[-1]["rerank_batches"] = {
+                "batches": batches,
+                "mean_pairs": round((after["pairs"] - before["pairs"]) / batches, 1) if batches else 0.0,
+                "mean_requests": round((after["requests"] - before["requests"]) / batches, 2) if batches else 0.0,
+            }
+
+    print_levels(levels, mode)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({
+            "target": args.target,
+            "mode": mode,
+            "expand": args.expand,
+            "caches": args.keep_caches,
+            "llm": "configured" if args.real_llm else "fake",
+            "startup_s": round(startup_s, 2),
+            "questions": len(questions),
+            "levels": levels,
+        }, f, indent=2)
+    print(f"💾 Results saved to '{args.output}'")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+import contextlib
+import glob
+import json
+import math
+import os
+import re
+from collections import Counter, namedtuple
+import numpy as np
+
+# --- CONFIGURATION ---
+INDEX_DIR = "local_index" # One folder per collection: points.json + the dense matrix it names
+DENSE_DTYPE = "float32" # "float16" halves the matrix on disk and in memory; scores are still summed in float32
+BM25_K1 = 1.5
+BM25_B = 0.75
+RRF_K = 60 # Fuses the dense and BM25 rankings, like Qdrant's hybrid query
+SCROLL_BATCH = 1000
+# ---------------------
+
+# Quacks like a Qdrant ScoredPoint for fuse_results, rerank and _hit_payload
+LocalHit = namedtuple("LocalHit", ["id", "score", "payload"])
+
+_TOKEN = re.compile(r"\w+")
+
+def tokenize(text):
+    return _TOKEN.findall(text.lower())
+
+class BM25:
+    """
+    Okapi BM25 over an in-memory inverted index: term -> (doc indices, term
+    frequencies) as NumPy arrays, so a query costs one vectorized update per
+    query term.
+    """
+
+    def __init__(self, texts, k1=BM25_K1, b=BM25_B):
+        postings = {}
+        lengths = np.zeros(len(texts), dtype=np.float32)
+        for doc, text in enumerate(texts):
+            tokens = tokenize(text)
+            lengths[doc] = len(tokens)
+            for term, tf in Counter(tokens).items():
+                docs, tfs = postings.setdefault(term, ([], []))
+                docs.append(doc)
+                tfs.append(tf)
+
+        self.size = len(texts)
+        self.k1 = k1
+        avg_length = float(lengths.mean()) if self.size else 1.0
+        # The document-length part of the BM25 denominator, precomputed per doc
+        self.length_norm = k1 * (1 - b + b * lengths / (avg_length or 1.0))
+        self.postings = {}
+        for term, (docs, tfs) in postings.items():
+            idf = math.log(1 + (self.size - len(docs) + 0.5) / (len(docs) + 0.5))
+            self.postings[term] = (idf, np.array(docs, dtype=np.int32), np.array(tfs, dtype=np.float32))
+
+    def scores(self, query):
+        scores = np.zeros(self.size, dtype=np.float32)
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            idf, docs, tfs = posting
+            scores[docs] += idf * tfs * (self.k1 + 1) / (tfs + self.length_norm[docs])
+        return scores
+
+def _top_k(scores, k, valid=None):
+    """
+    Indices of the k highest scores (only where valid), best first.
+    argpartition keeps this linear in the number of documents.
+    """
+    candidates = np.flatnonzero(valid) if valid is not None else np.arange(len(scores))
+    if len(candidates) > k:
+        candidates = candidates[np.argpartition(-scores[candidates], k)[:k]]
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+class LocalHybridIndex:
+    """
+    Memory-resident copy of one Qdrant collection for small corpora: the
+    dense vectors as a normalized, memory-mapped NumPy matrix plus a BM25
+    inverted index over the chunk text. Searching it needs no Qdrant call
+    and no client lock.
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, "points.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.path = path
+        self.version = meta["version"]
+        self.dtype = meta["dtype"]
+        self.ids = meta["ids"]
+        self.payloads = meta["payloads"]
+        self.dense = np.load(os.path.join(path, meta["dense_file"]), mmap_mode="r")
+        self.bm25 = BM25([payload.get("content", "") for payload in self.payloads])
+
+    @staticmethod
+    def build(client, collection_name, version, lock=None, index_dir=INDEX_DIR, dtype=DENSE_DTYPE):
+        """
+        Exports a collection's points (ids, payloads, dense vectors) from
+        Qdrant into index_dir/<collection>. Reusing Qdrant's vectors keeps
+        results comparable and avoids embedding the corpus again.
+        """
+        dense_name = client.get_vector_field_name()
+        ids, payloads, vectors = [], [], []
+        offset = None
+        while True:
+            with lock or contextlib.nullcontext():
+                points, offset = client.scroll(
+                    collection_name=collection_name,
+                    with_payload=True,
+                    with_vectors=[dense_name],
+                    limit=SCROLL_BATCH,
+                    offset=offset,
+                )
+            for point in points:
+                vector = point.vector[dense_name] if isinstance(point.vector, dict) else point.vector
+                payload = dict(point.payload)
+                payload.pop("document", None) # Same text as "content"
+                ids.append(str(point.id))
+                payloads.append(payload)
+                vectors.append(vector)
+            if offset is None:
+                break
+
+        if vectors:
+            dense = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1)
+        else: # Collection created but nothing embedded yet; search_batch returns no hits
+            dense = np.zeros((0, 0), dtype=np.float32)
+        norms = np.linalg.norm(dense, axis=1, keepdims=True)
+        dense = (dense / np.where(norms == 0, 1.0, norms)).astype(dtype)
+
+        path = os.path.join(index_dir, collection_name)
+        os.makedirs(path, exist_ok=True)
+        # A new file per version: an index still serving queries keeps its
+        # memory map of the old one instead of seeing it rewritten underneath
+        dense_file = f"dense-{version}-{dtype}.npy"
+        np.save(os.path.join(path, dense_file), dense)
+        tmp_path = os.path.join(path, "points.json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": version, "dtype": dtype, "dense_file": dense_file, "ids": ids, "payloads": payloads},
+                      f, ensure_ascii=False)
+        # Written last, so a half-built index is never mistaken for a current one
+        os.replace(tmp_path, os.path.join(path, "points.json"))
+        for old in glob.glob(os.path.join(path, "dense-*.npy")):
+            if os.path.basename(old) != dense_file:
+                try:
+                    os.remove(old)
+                except OSError: # Still mapped on Windows; goes with the next rebuild
+                    pass
+        print(f"   🗂️ Built local index for '{collection_name}': {len(ids)} points, {dense.nbytes / 2**20:.1f} MB dense")
+        return path
+
+    @classmethod
+    def load(cls, client, collection_name, version, lock=None, index_dir=INDEX_DIR, dtype=DENSE_DTYPE):
+        """
+        Loads the saved index, rebuilding it first if it is missing, from an
+        older version of the collection, or saved with another dtype.
+        """
+        path = os.path.join(index_dir, collection_name)
+        try:
+            with open(os.path.join(path, "points.json"), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            current = meta["version"] == version and meta["dtype"] == dtype
+        except (OSError, ValueError, KeyError):
+            current = False
+        if not current:
+            cls.build(client, collection_name, version, lock, index_dir, dtype)
+        return cls(path)
+
+    def _mask(self, filters):
+        """
+        Same semantics as retrieve.build_filter: every field must match, and
+        a list value (or list payload such as page_numbers) matches if any
+        item does.
+        """
+        mask = None
+        for key, value in (filters or {}).items():
+            if value is None or value == []:
+                continue
+            wanted = set(value) if isinstance(value, (list, tuple, set)) else {value}
+            field = np.fromiter(
+                (not wanted.isdisjoint(v if isinstance(v, list) else [v])
+                 for v in (payload.get(key) for payload in self.payloads)),
+                dtype=bool,
+                count=len(self.payloads),
+            )
+            mask = field if mask is None else mask & field
+        return mask
+
+    def search_batch(self, queries, dense_vectors, filters=None, limit=25):
+        """
+        Hybrid search for each query: the top `limit` by cosine similarity
+        and the top `limit` by BM25, fused with RRF. Returns one list of
+        LocalHit per query, best first.
+        """
+        if not self.ids:
+            return [[] for _ in queries]
+        mask = self._mask(filters)
+        if mask is not None and not mask.any():
+            return [[] for _ in queries]
+
+        matrix = np.asarray(dense_vectors, dtype=np.float32).reshape(len(queries), -1)
+        matrix = matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        # One matrix product scores every query against every chunk
+        dense_scores = np.asarray(self.dense @ matrix.T, dtype=np.float32)
+
+        result_lists = []
+        for j, query in enumerate(queries):
+            keyword_scores = self.bm25.scores(query)
+            matched = keyword_scores > 0
+            fused = {}
+            for ranking in (_top_k(dense_scores[:, j], limit, mask),
+                            _top_k(keyword_scores, limit, matched if mask is None else matched & mask)):
+                for rank, doc in enumerate(ranking.tolist(), start=1):
+                    fused[doc] = fused.get(doc, 0.0) + 1.0 / (RRF_K + rank)
+            best = sorted(fused.items(), key=lambda item: item[1], reverse=True)[:limit]
+            result_lists.append([LocalHit(self.ids[doc], score, self.payloads[doc]) for doc, score in best])
+        return result_lists
@@ -0,0 +1,90 @@
+import argparse
+import json
+import os
+from pathlib import Path
+from ingest import iter_structured_blocks, ingest_settings, INGEST_WORKERS
+from chunking import iter_semantic_chunks, chunking_settings
+from index import index_chunks, COLLECTION_NAME
+from artifacts import write_jsonl, read_records
+from cache import DiskCache, file_digest, content_digest
+from tracing import trace
+
+# --- CONFIGURATION ---
+SAVE_ARTIFACTS = False # Also write raw blocks / chunks as JSON Lines while streaming
+ARTIFACTS_DIR = "."
+INGEST_CACHE_DIR = "ingest_cache"
+INGEST_CACHE_MAX_BYTES = 2 * 1024 ** 3 # Least recently used documents are evicted past this
+# ---------------------
+
+_ingest_cache = DiskCache(INGEST_CACHE_DIR, max_bytes=INGEST_CACHE_MAX_BYTES)
+
+def _renamed(records, source, get_meta):
+    # Cached artifacts carry the name the file had when first processed
+    for record in records:
+        get_meta(record)["source"] = source
+        yield record
+
+def iter_document_chunks(file_path, use_cache=True, workers=INGEST_WORKERS):
+    """
+    Chunks for a document, served from the ingestion cache when the same
+    bytes were processed before with the same settings (under any file
+    name). Misses stream through ingest and chunking and fill the cache.
+    """
+    source = Path(file_path).name
+    if not use_cache:
+        return iter_semantic_chunks(iter_structured_blocks(file_path, workers=workers, strict=True))
+
+    key = file_digest(file_path, extra=ingest_settings())
+    # Blocks only depend on ingest settings; chunks also on the chunk budgets
+    chunks_name = f"chunks-{content_digest(json.dumps(chunking_settings(), sort_keys=True))}.jsonl"
+
+    cached_chunks = _ingest_cache.get(key, chunks_name)
+    if cached_chunks:
+        print(f"   💾 Ingestion cache hit: reusing chunks for '{source}'.")
+        return _renamed(read_records(cached_chunks), source, lambda chunk: chunk)
+
+    cached_blocks = _ingest_cache.get(key, "blocks.jsonl")
+    if cached_blocks:
+        print(f"   💾 Ingestion cache hit: reusing extracted blocks for '{source}'.")
+        blocks = _renamed(read_records(cached_blocks), source, lambda block: block["metadata"])
+    else:
+        blocks = _ingest_cache.stream_into(key, "blocks.jsonl",
+                                           iter_structured_blocks(file_path, workers=workers, strict=True))
+
+    return _ingest_cache.stream_into(key, chunks_name, iter_semantic_chunks(blocks))
+
+def run_pipeline(file_path, client=None, embedders=None, collection_name=COLLECTION_NAME,
+                 save_artifacts=SAVE_ARTIFACTS, artifacts_dir=ARTIFACTS_DIR, use_cache=True):
+    """
+    Ingest -> chunk -> index as one stream of generators. Blocks flow into
+    the chunker as they are extracted and chunks flow into embedding batches
+    as they are closed, so no stage holds the whole document.
+    Returns index_chunks' added/updated/removed/refreshed/unchanged report.
+    """
+    print(f"🚀 Streaming pipeline for '{file_path}'...")
+
+    if save_artifacts:
+        # Artifacts need the raw blocks, so run the stages explicitly
+        blocks = write_jsonl(iter_structured_blocks(file_path, strict=True),
+                             os.path.join(artifacts_dir, "raw_data.jsonl"))
+        chunks = iter_semantic_chunks(blocks)
+    else:
+        chunks = iter_document_chunks(file_path, use_cache=use_cache)
+
+    if save_artifacts:
+        chunks = write_jsonl(chunks, os.path.join(artifacts_dir, "semantic_chunks.jsonl"))
+
+    # The stages are lazy, so every one of them runs (and is timed) inside this trace
+    with trace("pipeline", file=str(file_path)):
+        return index_chunks(chunks, client=client, embedders=embedders, collection_name=collection_name)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest, chunk and index a document in one streaming pass")
+    parser.add_argument("file")
+    parser.add_argument("--collection", default=COLLECTION_NAME)
+    parser.add_argument("--save-artifacts", action="store_true", help="Write raw_data.jsonl and semantic_chunks.jsonl")
+    parser.add_argument("--no-cache", action="store_true", help="Ignore the ingestion cache")
+    args = parser.parse_args()
+
+    run_pipeline(args.file, collection_name=args.collection, save_artifacts=args.save_artifacts,
+                 use_cache=not args.no_cache)
@@ -1,14 +1,51 @@
 from qdrant_client import QdrantClient
+from qdrant_client.http import models
 from sentence_transformers import CrossEncoder
-from groq import Groq
 import os
+import queue
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
 from dotenv import load_dotenv
+from cache import LRUCache, normalize_query, content_digest
+from corpus import CorpusRegistry, REGISTRY_FILE
+from local_index import LocalHybridIndex
+from llm import get_llm
+from tracing import trace, span, record, annotate, bind, count
 
 load_dotenv()
 
 # --- CONFIGURATION ---
 COLLECTION_NAME = "rag_collection_demo" # Using the existing collection as per user state
 RERANKER_MODEL_NAME = "BAAI/bge-reranker-base" 
+DB_PATH = "qdrant_db"
+SEARCH_BACKEND = "qdrant" # "qdrant", or "local" (in-process NumPy + BM25 copy of each collection, for small corpora)
+SEARCH_LIMIT = 25 # Candidates per query variation
+TOP_K = 8 # Chunks handed to the generator
+FUSION_METHOD = "rrf" # "rrf" or "weighted"
+RRF_K = 60 # Standard RRF damping constant
+RERANK_CANDIDATES = 24 # Fused candidates sent to the CrossEncoder (None = all)
+RERANKER_BACKEND = "torch" # "torch" or "onnx" (int8-quantized, CPU)
+RERANKER_MAX_LENGTH = 512 # Tokens per (query, chunk) pair; longer chunks are truncated
+RERANKER_BATCH_SIZE = 16
+RERANK_BATCHING = True # Merge pairs from concurrent questions into shared predict() calls
+RERANK_MAX_BATCH = 128 # Pairs collected per merged call
+RERANK_MAX_WAIT_MS = 5.0 # How long a lone request waits for others to join its batch
+ONNX_CACHE_DIR = "onnx_models"
+SCORE_CACHE_SIZE = 50000 # Cached (query, chunk) scores
+SCORE_CACHE_PATH = "rerank_cache.json" # None keeps the cache in memory only
+SCORE_CACHE_SAVE_EVERY = 2000 # New scores before the file is rewritten (also saved at exit)
+SCORE_CACHE_SAVE_INTERVAL = 300.0 # Seconds at least between rewrites; each one serializes the whole cache
+EXPANSION_MODEL_NAME = "llama-3.3-70b-versatile"
+EXPANSION_ENABLED = True
+EXPANSION_DETERMINISTIC = True # temperature 0 + fixed seed, so variations are stable per query
+EXPANSION_TIMEOUT = 3.0 # Seconds before falling back to the original query
+EXPANSION_CACHE_SIZE = 5000
+EXPANSION_CACHE_TTL = 7 * 24 * 3600 # Seconds
+EXPANSION_CACHE_PATH = "expansion_cache.json"
+RETRIEVAL_BUDGET = 4.0 # Seconds from question to reranking; late expansions are dropped
 API_KEY = os.getenv("GROQ_API_KEY")
 
 # Check if API Key is available
@@ -17,18 +54,31 @@ if not API_KEY and "gsk_" not in str(os.getenv("GROQ_API_KEY", "")):
     print("⚠️ WARNING: GROQ_API_KEY not found in environment.")
 # ---------------------
 
-def generate_query_variations(query):
+_expansion_cache = LRUCache(max_size=EXPANSION_CACHE_SIZE, ttl=EXPANSION_CACHE_TTL, path=EXPANSION_CACHE_PATH)
+
+def generate_query_variations(query, expand=EXPANSION_ENABLED, timeout=EXPANSION_TIMEOUT):
     """
     Uses LLM to generate 3 variations of the user query for better coverage.
+    Results are cached per normalized query. With expand=False, or when the
+    LLM doesn't answer within `timeout` seconds, only the original query is used.
     """
+    if not expand:
+        return [query]
+
     print(f"   ✨ Generating query variations for: '{query}'")
+
+    cache_key = f"{EXPANSION_MODEL_NAME}:{EXPANSION_DETERMINISTIC}|{normalize_query(query)}"
+    cached = _expansion_cache.get(cache_key)
+    if cached is not None:
+        print("   💾 Using cached query variations.")
+        count("expansion.cache_hits")
+        # Keep the user's exact wording as the first query
+        return [query] + cached
     
     if not API_KEY:
         print("   ⚠️ No API Key, skipping expansion.")
         return [query]
 
-    client = Groq(api_key=API_KEY)
-    
     prompt = f"""
     You are an AI assistant. Your task is to generate 3 different search queries based on the user's question.
     These queries should be optimized for a Vector Search engine (semantic similarity).
@@ -37,119 +87,762 @@ def generate_query_variations(query):
     
     Return ONLY the 3 queries, one per line. Do not include numbering or bullets.
     """
+
+    sampling = {"temperature": 0.0, "seed": 0} if EXPANSION_DETERMINISTIC else {"temperature": 0.7}
     
     try:
-        completion = client.chat.completions.create(
-            messages=[{"role": "user", "content": prompt}],
-            model="llama-3.3-70b-versatile",
-            temperature=0.7,
-        )
-        content = completion.choices[0].message.content
-        variations = [line.strip() for line in content.split("\n") if line.strip()]
+        # Shared LLM client; no retries, expansion has to fit in its timeout
+        with span("retrieve.expand", model=EXPANSION_MODEL_NAME):
+            content = get_llm().complete(
+                [{"role": "user", "content": prompt}],
+                EXPANSION_MODEL_NAME,
+                timeout=timeout,
+                retries=0,
+                **sampling,
+            )
+        variations = [line.strip() for line in content.split("\n") if line.strip()][:3]
+        _expansion_cache.put(cache_key, variations)
         # Always include the original query!
-        variations.insert(0, query)
-        return variations[:4] # Cap at 4 total
+        return [query] + variations # Cap at 4 total
     except Exception as e:
         print(f"   ⚠️ Query expansion failed: {e}. using original query only.")
         return [query]
 
-def search_and_rerank(query_text):
-    print(f"\n🔎 User Query: '{query_text}'")
-    
-    # 1. Initialize Client
-    client = QdrantClient(path="qdrant_db")
-    
-    # 2. QUERY EXPANSION
-    queries = generate_query_variations(query_text)
-    print(f"   🔍 Searching for: {queries}")
+def _hit_payload(hit):
+    # FastEmbed's client.query returns .metadata, query_points returns .payload
+    return hit.metadata if hasattr(hit, "metadata") else hit.payload
 
-    all_results = []
-    
-    # 3. HYBRID SEARCH (Loop through variations)
-    for q in queries:
-        # We rely on client.query doing the embedding automatically via FastEmbed
-        # (Assuming the collection was created with FastEmbed support as per index.py)
+def build_filter(filters):
+    """
+    Turns {"source": "a.pdf", "subject_context": [...], "page_numbers": [3, 4]}
+    into a Qdrant filter. List values match any of their items; None is ignored.
+    """
+    if not filters:
+        return None
+    must = []
+    for key, value in filters.items():
+        if value is None or value == []:
+            continue
+        values = list(value) if isinstance(value, (list, tuple, set)) else [value]
+        must.append(models.FieldCondition(key=key, match=models.MatchAny(any=values)))
+    return models.Filter(must=must) if must else None
+
+def fuse_results(result_lists, method=FUSION_METHOD, rrf_k=RRF_K, weights=None):
+    """
+    Merges one ranked hit list per query variation into a single list of
+    (fused_score, hit), best first, deduplicated by hit.id.
+
+    "rrf" sums 1 / (rrf_k + rank) over the lists a hit appears in.
+    "weighted" sums the min-max normalized search scores instead.
+    weights optionally scales each list (e.g. to favour the original query).
+    """
+    if weights is None:
+        weights = [1.0] * len(result_lists)
+
+    fused = {}
+    hits = {}
+    for hits_list, weight in zip(result_lists, weights):
+        if not hits_list:
+            continue
+        if method == "weighted":
+            scores = [hit.score for hit in hits_list]
+            low, high = min(scores), max(scores)
+            score_range = (high - low) or 1.0
+        for rank, hit in enumerate(hits_list, start=1):
+            if method == "rrf":
+                contribution = 1.0 / (rrf_k + rank)
+            elif method == "weighted":
+                contribution = (hit.score - low) / score_range
+            else:
+                raise ValueError(f"Unknown fusion method: {method}")
+            fused[hit.id] = fused.get(hit.id, 0.0) + weight * contribution
+            hits.setdefault(hit.id, hit)
+
+    ranked = sorted(fused.items(), key=lambda item: item[1], reverse=True)
+    return [(score, hits[hit_id]) for hit_id, score in ranked]
+
+class Reranker(ABC):
+    """
+    Base class for CrossEncoder backends. predict() sorts pairs by length so
+    each batch pads to similar-sized inputs, then restores the caller's order.
+    """
+
+    def __init__(self, model_name=RERANKER_MODEL_NAME, max_length=RERANKER_MAX_LENGTH, batch_size=RERANKER_BATCH_SIZE):
+        self.model_name = model_name
+        self.max_length = max_length
+        self.batch_size = batch_size
+
+    @abstractmethod
+    def score_batch(self, pairs):
+        """
+        Raw scores for one batch of (query, passage) pairs, in order.
+        """
+
+    def predict(self, pairs):
+        # Character length is a cheap, good-enough proxy for token length here
+        order = sorted(range(len(pairs)), key=lambda i: len(pairs[i][0]) + len(pairs[i][1]))
+        scores = [0.0] * len(pairs)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            for i, score in zip(batch, self.score_batch([pairs[i] for i in batch])):
+                scores[i] = float(score)
+        return scores
+
+class TorchReranker(Reranker):
+    """
+    sentence-transformers CrossEncoder on PyTorch.
+    """
+
+    def __init__(self, model_name=RERANKER_MODEL_NAME, max_length=RERANKER_MAX_LENGTH, batch_size=RERANKER_BATCH_SIZE):
+        super().__init__(model_name, max_length, batch_size)
+        self.model = CrossEncoder(model_name, max_length=max_length)
+
+    def score_batch(self, pairs):
+        return self.model.predict(pairs, batch_size=len(pairs), show_progress_bar=False)
+
+class OnnxReranker(Reranker):
+    """
+    The same model exported to ONNX Runtime and dynamically quantized to int8.
+    The export runs once and is cached under ONNX_CACHE_DIR.
+    """
+
+    def __init__(self, model_name=RERANKER_MODEL_NAME, max_length=RERANKER_MAX_LENGTH, batch_size=RERANKER_BATCH_SIZE,
+                 cache_dir=ONNX_CACHE_DIR):
+        super().__init__(model_name, max_length, batch_size)
+        import numpy as np
+        from optimum.onnxruntime import ORTModelForSequenceClassification
+        from transformers import AutoTokenizer
+
+        self._np = np
+        model_dir = os.path.join(cache_dir, model_name.replace("/", "__") + "-int8")
+        if not os.path.exists(os.path.join(model_dir, "model_quantized.onnx")):
+            self._export(model_name, model_dir)
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.model = ORTModelForSequenceClassification.from_pretrained(model_dir, file_name="model_quantized.onnx")
+
+    @staticmethod
+    def _export(model_name, model_dir):
+        from optimum.onnxruntime import ORTModelForSequenceClassification, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        from transformers import AutoTokenizer
+
+        print(f"   🛠️ Exporting {model_name} to int8 ONNX (one-time)...")
+        model = ORTModelForSequenceClassification.from_pretrained(model_name, export=True)
+        model.save_pretrained(model_dir)
+        AutoTokenizer.from_pretrained(model_name).save_pretrained(model_dir)
+
+        quantizer = ORTQuantizer.from_pretrained(model)
+        config = AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+        quantizer.quantize(save_dir=model_dir, quantization_config=config)
+
+    def score_batch(self, pairs):
+        features = self.tokenizer(
+            [query for query, _ in pairs],
+            [text for _, text in pairs],
+            padding=True,
+            truncation="only_second",
+            max_length=self.max_length,
+            return_tensors="np",
+        )
+        logits = self._np.asarray(self.model(**features).logits)[:, 0]
+        # CrossEncoder applies a sigmoid to single-label models; match its scale
+        return 1.0 / (1.0 + self._np.exp(-logits))
+
+class BatchingReranker:
+    """
+    Dynamic micro-batching in front of a Reranker, for concurrent questions.
+    predict() queues the caller's pairs; a single worker thread takes what
+    is queued (up to max_batch pairs, waiting at most max_wait_ms for more),
+    scores it in one predict() call and hands each caller its own scores.
+    Pairs from different questions are length-sorted into the same forward
+    passes, and inference never competes with itself for the CPU.
+    """
+
+    def __init__(self, reranker, max_batch=RERANK_MAX_BATCH, max_wait_ms=RERANK_MAX_WAIT_MS):
+        self.reranker = reranker
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._stats = {"batches": 0, "requests": 0, "pairs": 0, "largest": 0}
+        self._sizes = deque(maxlen=1000) # Pairs per merged call, for percentiles
+        threading.Thread(target=self._worker, name="rerank-batcher", daemon=True).start()
+
+    def predict(self, pairs):
+        if not pairs:
+            return []
+        future = Future()
+        self._queue.put((pairs, future))
+        return future.result()
+
+    def _worker(self):
+        while True:
+            batch = [self._queue.get()]
+            size = len(batch[0][0])
+            deadline = time.perf_counter() + self.max_wait
+            while size < self.max_batch:
+                try:
+                    # Whatever queued while the last batch ran is taken at once
+                    item = self._queue.get(timeout=max(0.0, deadline - time.perf_counter()))
+                except queue.Empty:
+                    break
+                batch.append(item)
+                size += len(item[0])
+            self._run(batch)
+
+    def _run(self, batch):
+        pairs = [pair for request_pairs, _ in batch for pair in request_pairs]
+        start = time.perf_counter()
         try:
-            search_results = client.query(
-                collection_name=COLLECTION_NAME,
-                query_text=q,
-                limit=25 # Grab 25 per variation
-            )
-            all_results.extend(search_results)
+            scores = self.reranker.predict(pairs)
         except Exception as e:
-            print(f"   ⚠️ Search failed for query '{q}': {e}")
-            
-    print(f"   ...Collected {len(all_results)} raw candidates...")
-
-    # 4. DEDUPLICATION
-    # We remove duplicates based on the ID
-    unique_results = {}
-    for hit in all_results:
-        # Use database ID as unique key
-        if hit.id not in unique_results:
-            unique_results[hit.id] = hit
-    
-    candidates = list(unique_results.values())
-    print(f"   ...Deduplicated to {len(candidates)} unique candidates...")
-    
-    if not candidates:
-        print("   ❌ No documents found.")
-        return []
-    
-    # 5. PREPARE FOR RERANKER
-    passages = []
-    cross_encoder_inputs = []
-    
-    for hit in candidates:
-        # Handle metadata safely
-        text = hit.metadata.get("content", "") if hasattr(hit, "metadata") else hit.payload.get("content", "")
-        if not text:
-             continue
-             
-        passages.append(hit) 
-        # Compare Query vs Text. We use the ORIGINAL query for reranking, 
-        # because that is the user's true intent.
-        cross_encoder_inputs.append([query_text, text]) 
-
-    # 6. RERANKING
-    print(f"   ...Reranking {len(candidates)} candidates with {RERANKER_MODEL_NAME}...")
-    
-    try:
-        model = CrossEncoder(RERANKER_MODEL_NAME)
-        scores = model.predict(cross_encoder_inputs)
-        
-        # 7. SORT & FILTER
-        ranked_results = sorted(zip(scores, passages), key=lambda x: x[0], reverse=True)
-        
-        # Keep Top 8
-        final_top_8 = []
-        for score, hit in ranked_results[:8]:
-            # Handle metadata access again
-            content = hit.metadata.get("content", "") if hasattr(hit, "metadata") else hit.payload.get("content", "")
-            meta = hit.metadata if hasattr(hit, "metadata") else hit.payload
-            
-            final_top_8.append({
-                "score": float(score),
-                "text": content,
-                "meta": meta
-            })
-
-        print(f"   ✅ Returning top {len(final_top_8)} highly relevant chunks.\n")
-        return final_top_8
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        record("rerank.batch", time.perf_counter() - start, pairs=len(pairs), requests=len(batch))
+        count("rerank.batches")
 
-    except Exception as e:
-        print(f"   ❌ Reranking failed: {e}. Returning unranked top results.")
-        # Fallback: just return the top search results without reranking logic if model fails
-        fallback = []
-        for hit in candidates[:5]:
-             content = hit.metadata.get("content", "") if hasattr(hit, "metadata") else hit.payload.get("content", "")
-             meta = hit.metadata if hasattr(hit, "metadata") else hit.payload
-             fallback.append({"score": 0.0, "text": content, "meta": meta})
-        return fallback
+        offset = 0
+        for request_pairs, future in batch:
+            future.set_result(scores[offset:offset + len(request_pairs)])
+            offset += len(request_pairs)
+
+        with self._stats_lock:
+            self._stats["batches"] += 1
+            self._stats["requests"] += len(batch)
+            self._stats["pairs"] += len(pairs)
+            self._stats["largest"] = max(self._stats["largest"], len(pairs))
+            self._sizes.append(len(pairs))
+
+    def stats(self):
+        """
+        Achieved batch sizes: mean pairs and requests per merged call, the
+        median and largest call.
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+            sizes = sorted(self._sizes)
+        batches = stats["batches"]
+        stats["mean_pairs"] = stats["pairs"] / batches if batches else 0.0
+        stats["mean_requests"] = stats["requests"] / batches if batches else 0.0
+        stats["median_pairs"] = sizes[len(sizes) // 2] if sizes else 0
+        return stats
+
+RERANKER_BACKENDS = {
+    "torch": TorchReranker,
+    "onnx": OnnxReranker,
+}
+
+def load_reranker(backend=RERANKER_BACKEND, model_name=RERANKER_MODEL_NAME, **kwargs):
+    if backend not in RERANKER_BACKENDS:
+        raise ValueError(f"Unknown reranker backend: {backend}")
+    return RERANKER_BACKENDS[backend](model_name=model_name, **kwargs)
+
+class ScoreCache:
+    """
+    Reranker scores keyed by normalized query + chunk content digest, so a
+    chunk whose text changes on re-index can never hit a stale score.
+    The namespace keeps scores from different models/settings apart.
+    """
+
+    def __init__(self, namespace, max_size=SCORE_CACHE_SIZE, path=SCORE_CACHE_PATH):
+        self.namespace = namespace
+        self.cache = LRUCache(max_size=max_size, path=path, save_every=SCORE_CACHE_SAVE_EVERY,
+                              save_interval=SCORE_CACHE_SAVE_INTERVAL)
+
+    def key(self, query, text):
+        return f"{self.namespace}|{content_digest(text)}|{normalize_query(query)}"
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def put(self, key, score):
+        self.cache.put(key, score)
+
+    def retain_chunks(self, digests):
+        """
+        Drops scores for chunks that are no longer indexed.
+        """
+        return self.cache.remove_where(lambda key: key.split("|", 2)[1] not in digests)
+
+    def stats(self):
+        return self.cache.stats()
+
+class Retriever:
+    """
+    Long-lived retrieval engine. The Qdrant client, the FastEmbed embedders and
+    the CrossEncoder are loaded once and reused by every query.
+    """
+
+    def __init__(self, db_path=DB_PATH, collection_name=COLLECTION_NAME, reranker_model_name=RERANKER_MODEL_NAME,
+                 fusion_method=FUSION_METHOD, rerank_candidates=RERANK_CANDIDATES, reranker_backend=RERANKER_BACKEND,
+                 use_score_cache=True, budget=RETRIEVAL_BUDGET, rerank_batching=RERANK_BATCHING,
+                 search_backend=SEARCH_BACKEND):
+        if search_backend not in ("qdrant", "local"):
+            raise ValueError(f"Unknown search backend: {search_backend}")
+        self.db_path = db_path
+        self.collection_name = collection_name
+        self.reranker_model_name = reranker_model_name
+        self.reranker_backend = reranker_backend
+        self.fusion_method = fusion_method
+        self.rerank_candidates = rerank_candidates
+        self.rerank_batching = rerank_batching
+        self.search_backend = search_backend
+        self.budget = budget
+
+        self.client = None
+        self.embedder = None
+        self.sparse_embedder = None
+        self.reranker = None
+        self.score_cache = None
+        if use_score_cache:
+            self.score_cache = ScoreCache(f"{reranker_model_name}:{reranker_backend}:{RERANKER_MAX_LENGTH}")
+
+        self._load_lock = threading.Lock()
+        self._local_indexes = {} # collection -> LocalHybridIndex
+        self._local_lock = threading.Lock()
+        self._registry = (None, None) # (file stamp, CorpusRegistry), swapped as one value
+        # Local Qdrant isn't built for concurrent access from several threads;
+        # anything sharing self.client (e.g. background indexing) takes this lock.
+        self.client_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="retriever")
+
+    def _ensure_loaded(self):
+        """
+        Loads whatever is not loaded yet. Returns the seconds spent doing so,
+        which is 0.0 once the engine is warm.
+        """
+        if self.reranker is not None:
+            return 0.0
+
+        with self._load_lock:
+            start = time.perf_counter()
+            if self.client is None:
+                # Local mode holds a file lock, so one client per process.
+                self.client = QdrantClient(path=self.db_path)
+            if self.embedder is None:
+                from fastembed import TextEmbedding
+                self.embedder = TextEmbedding(model_name=self.client.embedding_model_name)
+                if self.client.sparse_embedding_model_name:
+                    from fastembed import SparseTextEmbedding
+                    self.sparse_embedder = SparseTextEmbedding(model_name=self.client.sparse_embedding_model_name)
+            if self.reranker is None:
+                reranker = load_reranker(self.reranker_backend, self.reranker_model_name)
+                # Concurrent questions (app sessions, load tests) share forward passes
+                self.reranker = BatchingReranker(reranker) if self.rerank_batching else reranker
+            return time.perf_counter() - start
+
+    def warm_up(self):
+        """
+        Pays the cold start up front: loads every model and runs one dummy
+        embedding, search and rerank so the first real question is fast.
+        """
+        print("🔥 Warming up retrieval engine...")
+        setup = self._ensure_loaded()
+
+        start = time.perf_counter()
+        dense, sparse = self._embed_queries(["warm up"])[0]
+        if self.client.collection_exists(collection_name=self.collection_name):
+            if self.search_backend == "local":
+                self.search_variations(["warm up"]) # Loads (or builds) the local indexes
+            else:
+                self._search(dense, sparse, limit=1)
+        self.reranker.predict([["warm up", "warm up"]])
+        print(f"   ✅ Engine ready (load {setup:.2f}s, first pass {time.perf_counter() - start:.2f}s).")
+        return self
+
+    def _embed_queries(self, texts):
+        """
+        Embeds every query variation in one dense (and one sparse) batch.
+        Returns a list of (dense, sparse) pairs in the same order as texts.
+        """
+        with span("retrieve.embed", queries=len(texts)):
+            dense = [vec.tolist() for vec in self.embedder.query_embed(texts)]
+            sparse = [None] * len(texts)
+            if self.sparse_embedder is not None:
+                sparse = [
+                    models.SparseVector(indices=emb.indices.tolist(), values=emb.values.tolist())
+                    for emb in self.sparse_embedder.query_embed(texts)
+                ]
+        return list(zip(dense, sparse))
+
+    def _query_request(self, dense, sparse, limit, query_filter=None):
+        """
+        Same hybrid search client.query performs, but with vectors we embedded
+        ourselves so the models are not re-resolved on every call. The filter
+        is applied inside Qdrant, before scoring.
+        """
+        dense_name = self.client.get_vector_field_name()
+        if sparse is None:
+            return models.QueryRequest(query=dense, using=dense_name, filter=query_filter, limit=limit, with_payload=True)
+        return models.QueryRequest(
+            prefetch=[
+                models.Prefetch(query=dense, using=dense_name, filter=query_filter, limit=limit),
+                models.Prefetch(query=sparse, using=self.client.get_sparse_vector_field_name(),
+                                filter=query_filter, limit=limit),
+            ],
+            query=models.FusionQuery(fusion=models.Fusion.RRF),
+            limit=limit,
+            with_payload=True,
+        )
+
+    def _search(self, dense, sparse, limit=SEARCH_LIMIT, query_filter=None, collection_name=None):
+        return self._search_batch([(dense, sparse)], limit, query_filter, collection_name)[0]
+
+    def _search_batch(self, embedded, limit=SEARCH_LIMIT, query_filter=None, collection_name=None):
+        """
+        Runs all searches as one query_batch_points call. Returns one hit list
+        per (dense, sparse) pair.
+        """
+        collection_name = collection_name or self.collection_name
+        with span("retrieve.qdrant", collection=collection_name, queries=len(embedded)) as s:
+            waiting = time.perf_counter()
+            with self.client_lock:
+                # Time spent behind background indexing on the shared client
+                s.set(lock_wait_ms=round((time.perf_counter() - waiting) * 1000, 3))
+                responses = self.client.query_batch_points(
+                    collection_name=collection_name,
+                    requests=[self._query_request(dense, sparse, limit, query_filter) for dense, sparse in embedded],
+                )
+        return [response.points for response in responses]
+
+    def _corpus(self):
+        """
+        The corpus registry, re-read only when its file has changed.
+        """
+        try:
+            stat = os.stat(REGISTRY_FILE)
+            stamp = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            stamp = None
+        cached_stamp, registry = self._registry
+        if registry is None or stamp != cached_stamp:
+            registry = CorpusRegistry()
+            self._registry = (stamp, registry)
+        return registry
+
+    def _collections_for(self, filters):
+        """
+        Only collections that hold the filtered sources (or any indexed
+        document) need to be searched.
+        """
+        sources = (filters or {}).get("source")
+        if isinstance(sources, str):
+            sources = [sources]
+        collections = self._corpus().collections(sources, default=self.collection_name)
+        return [c for c in collections if self.client.collection_exists(collection_name=c)]
+
+    def embed_query(self, text):
+        """
+        Dense embedding of one query, e.g. for the semantic answer cache.
+        """
+        self._ensure_loaded()
+        return next(iter(self.embedder.query_embed([text]))).tolist()
+
+    def corpus_version(self, filters=None):
+        """
+        Version of the indexed data a search with these filters would see.
+        Changes when any of the collections involved is re-indexed.
+        """
+        self._ensure_loaded()
+        return self._corpus().version(self._collections_for(filters))
+
+    def search_variations(self, queries, filters=None):
+        """
+        Embeds every variation in one batch and searches each relevant
+        collection with one batched call. Returns one ranked hit list per
+        (collection, query).
+        """
+        if not queries:
+            return []
+        if self.search_backend == "local":
+            return self._search_local(queries, filters)
+        embedded = self._embed_queries(queries)
+        query_filter = build_filter(filters)
+
+        result_lists = []
+        for collection_name in self._collections_for(filters):
+            try:
+                result_lists.extend(self._search_batch(embedded, SEARCH_LIMIT, query_filter, collection_name))
+            except Exception as e:
+                # One bad variation fails the whole batch, so retry them one by one
+                print(f"   ⚠️ Batch search failed in '{collection_name}': {e}. Retrying per variation...")
+                for q, (dense, sparse) in zip(queries, embedded):
+                    try:
+                        result_lists.append(self._search(dense, sparse, SEARCH_LIMIT, query_filter, collection_name))
+                    except Exception as e:
+                        print(f"   ⚠️ Search failed for query '{q}': {e}")
+        return result_lists
+
+    def _local_index(self, collection_name):
+        """
+        The collection's local index, rebuilt from Qdrant whenever the
+        collection has been re-indexed since it was saved.
+        """
+        version = self._corpus().version([collection_name])
+        index = self._local_indexes.get(collection_name)
+        if index is None or index.version != version:
+            with self._local_lock:
+                index = self._local_indexes.get(collection_name)
+                if index is None or index.version != version:
+                    index = LocalHybridIndex.load(self.client, collection_name, version, self.client_lock)
+                    self._local_indexes[collection_name] = index
+        return index
+
+    def _search_local(self, queries, filters=None):
+        """
+        search_variations for the "local" backend: dense query embeddings
+        (the sparse model isn't needed, BM25 works on the text) searched
+        against in-process indexes instead of Qdrant.
+        """
+        with span("retrieve.embed", queries=len(queries)):
+            dense = list(self.embedder.query_embed(queries))
+        result_lists = []
+        for collection_name in self._collections_for(filters):
+            try:
+                index = self._local_index(collection_name)
+                with span("retrieve.local", collection=collection_name, queries=len(queries)):
+                    result_lists.extend(index.search_batch(queries, dense, filters, SEARCH_LIMIT))
+            except Exception as e:
+                # Like a failed Qdrant search: skip the collection, keep the others
+                print(f"   ⚠️ Local search failed in '{collection_name}': {e}")
+        return result_lists
+
+    def retrieve_candidates(self, queries, filters=None):
+        """
+        Searches every variation, then fuses the per-variation rankings.
+        Returns [(fused_score, hit), ...] best first, unpruned.
+        """
+        result_lists = self.search_variations(queries, filters)
+        return fuse_results(result_lists, method=self.fusion_method)
+
+    def _expand_and_search(self, query_text, deadline, filters=None):
+        """
+        Expansion + search of the extra variations, given up once the
+        request's deadline has passed (the caller has stopped waiting, and
+        the executor's threads are needed by later requests).
+        """
+        timeout = min(EXPANSION_TIMEOUT, deadline - time.perf_counter())
+        if timeout <= 0:
+            return []
+        # expand=True: the caller asked for it, whatever EXPANSION_ENABLED says
+        queries = generate_query_variations(query_text, expand=True, timeout=timeout)
+        extra = [q for q in queries if q != query_text]
+        if not extra or time.perf_counter() >= deadline:
+            return []
+        print(f"   🔍 Expanded searches: {extra}")
+        return self.search_variations(extra, filters)
+
+    def rerank(self, query_text, hits, counts=None):
+        """
+        Scores (query, chunk) pairs with the CrossEncoder.
+        Returns [(score, hit), ...] best first. Hits without content are dropped.
+        If a counts dict is given, the score cache hits go in counts["cache_hits"].
+        """
+        passages = []
+        cross_encoder_inputs = []
+
+        for hit in hits:
+            text = _hit_payload(hit).get("content", "")
+            if not text:
+                continue
+
+            passages.append(hit)
+            # Compare Query vs Text. We use the ORIGINAL query for reranking,
+            # because that is the user's true intent.
+            cross_encoder_inputs.append([query_text, text])
+
+        if not cross_encoder_inputs:
+            return []
+        scores = self._cached_predict(cross_encoder_inputs, counts)
+        return sorted(zip(scores, passages), key=lambda x: x[0], reverse=True)
+
+    def _cached_predict(self, pairs, counts=None):
+        """
+        Only pairs missing from the score cache go to the CrossEncoder.
+        """
+        if self.score_cache is None:
+            count("rerank.pairs", len(pairs))
+            with span("rerank.predict", pairs=len(pairs)):
+                return self.reranker.predict(pairs)
+
+        keys = [self.score_cache.key(query, text) for query, text in pairs]
+        scores = [self.score_cache.get(key) for key in keys]
+        missing = [i for i, score in enumerate(scores) if score is None]
+        count("rerank.cache_hits", len(pairs) - len(missing))
+        if missing:
+            count("rerank.pairs", len(missing))
+            with span("rerank.predict", pairs=len(missing)):
+                fresh = self.reranker.predict([pairs[i] for i in missing])
+            for i, score in zip(missing, fresh):
+                scores[i] = float(score)
+                self.score_cache.put(keys[i], scores[i])
+
+        if counts is not None:
+            counts["cache_hits"] = len(pairs) - len(missing)
+        return scores
+
+    def invalidate_stale_scores(self):
+        """
+        Call after re-indexing: drops cached scores for chunks that are no
+        longer in the collection.
+        """
+        if self.score_cache is None:
+            return 0
+        self._ensure_loaded()
+        digests = set()
+        for collection_name in self._collections_for(None):
+            offset = None
+            while True:
+                with self.client_lock:
+                    points, offset = self.client.scroll(
+                        collection_name=collection_name,
+                        with_payload=["content"],
+                        limit=1000,
+                        offset=offset,
+                    )
+                digests.update(content_digest(p.payload.get("content", "")) for p in points)
+                if offset is None:
+                    break
+        removed = self.score_cache.retain_chunks(digests)
+        print(f"   🧹 Dropped {removed} cached reranker scores for changed chunks.")
+        return removed
+
+    def search_and_rerank(self, query_text, expand=EXPANSION_ENABLED, filters=None):
+        """
+        filters restricts the search server-side, e.g.
+        {"source": ["report.pdf"], "subject_context": "HARDWARE WORKSHOP"}.
+        """
+        return self.search_and_rerank_with_report(query_text, expand, filters)[0]
+
+    def search_and_rerank_with_report(self, query_text, expand=EXPANSION_ENABLED, filters=None):
+        """
+        Same as search_and_rerank, but returns (results, report). The report
+        belongs to this question only: {"timings", "counts", "fused"}, where
+        fused is [(fused_score, hit), ...] before pruning and reranking.
+        """
+        print(f"\n🔎 User Query: '{query_text}'" + (f" (filters: {filters})" if filters else ""))
+        # Per-question state stays local: the Retriever is shared by every request thread
+        timings = {"setup": self._ensure_loaded()}
+        counts = {}
+        work_start = time.perf_counter()
+
+        # 1. SPECULATIVE SEARCH
+        # The original query doesn't need the expansion, so search it right
+        # away while the LLM generates variations in the background.
+        deadline = time.perf_counter() + self.budget
+        expanded = None
+        if expand:
+            # bind() so the expansion's spans land in this request's trace
+            expanded = self._executor.submit(bind(self._expand_and_search), query_text, deadline, filters)
+
+        stage = time.perf_counter()
+        with span("retrieve.search"):
+            result_lists = self.search_variations([query_text], filters)
+        timings["search"] = time.perf_counter() - stage
+
+        # 2. JOIN EXPANDED SEARCHES (Whatever is ready before the deadline)
+        if expanded is not None:
+            stage = time.perf_counter()
+            with span("retrieve.expansion_wait") as s:
+                try:
+                    result_lists += expanded.result(timeout=max(0.0, deadline - time.perf_counter()))
+                except FutureTimeout:
+                    expanded.cancel() # Drops it if it hasn't started; otherwise it stops at its deadline check
+                    s.set(missed_budget=True)
+                    print(f"   ⏰ Expansion missed the {self.budget:.1f}s budget; reranking original results only.")
+                except Exception as e:
+                    print(f"   ⚠️ Expanded search failed: {e}")
+            timings["expansion_wait"] = time.perf_counter() - stage
+        counts["ranked_lists"] = len(result_lists)
+
+        # 3. FUSION
+        counts["raw"] = sum(len(hits) for hits in result_lists)
+        fused = fuse_results(result_lists, method=self.fusion_method)
+        counts["unique"] = len(fused)
+        print(f"   ...Fused {counts['raw']} raw hits from {len(result_lists)} queries into {len(fused)} unique candidates ({self.fusion_method})...")
+
+        if not fused:
+            print("   ❌ No documents found.")
+            return [], self._record(timings, counts, fused, work_start)
+
+        # 4. PRUNING
+        # Only the best fused candidates are worth a CrossEncoder pass
+        candidates = [hit for _, hit in fused[:self.rerank_candidates]]
+        counts["reranked"] = len(candidates)
+
+        # 5. RERANKING
+        print(f"   ...Reranking {len(candidates)} candidates with {self.reranker_model_name} ({self.reranker_backend})...")
+
+        stage = time.perf_counter()
+        try:
+            with span("retrieve.rerank", candidates=len(candidates)):
+                ranked_results = self.rerank(query_text, candidates, counts)
+
+            # 6. SORT & FILTER
+            final_top_k = []
+            for score, hit in ranked_results[:TOP_K]:
+                meta = _hit_payload(hit)
+                final_top_k.append({
+                    "score": float(score),
+                    "text": meta.get("content", ""),
+                    "meta": meta
+                })
+
+            timings["rerank"] = time.perf_counter() - stage
+            report = self._record(timings, counts, fused, work_start)
+            print(f"   ✅ Returning top {len(final_top_k)} highly relevant chunks.\n")
+            return final_top_k, report
+
+        except Exception as e:
+            print(f"   ❌ Reranking failed: {e}. Returning fused top results.")
+            # Fallback: the fused order is a decent ranking on its own
+            fallback = []
+            for _, hit in fused[:5]:
+                meta = _hit_payload(hit)
+                fallback.append({"score": 0.0, "text": meta.get("content", ""), "meta": meta})
+            timings["rerank"] = time.perf_counter() - stage
+            return fallback, self._record(timings, counts, fused, work_start)
+
+    def _record(self, timings, counts, fused, work_start):
+        timings["work"] = time.perf_counter() - work_start
+        timings["total"] = timings["setup"] + timings["work"]
+        annotate(**counts)
+        breakdown = ", ".join(f"{k} {v:.3f}s" for k, v in timings.items())
+        print(f"   ⏱️ {breakdown}")
+        if self.score_cache is not None:
+            stats = self.score_cache.stats()
+            print(f"   💾 Score cache: {stats['hits']} hits / {stats['misses']} misses ({stats['hit_rate']:.0%})")
+        if isinstance(self.reranker, BatchingReranker):
+            stats = self.reranker.stats()
+            print(f"   🧺 Rerank batches: {stats['batches']}, {stats['mean_pairs']:.0f} pairs / "
+                  f"{stats['mean_requests']:.1f} questions each on average (largest {stats['largest']})")
+        return {"timings": timings, "counts": counts, "fused": fused}
+
+_retriever = None
+_retriever_lock = threading.Lock()
+
+def get_retriever():
+    """
+    Returns the process-wide Retriever, creating it on first use.
+    """
+    global _retriever
+    if _retriever is None:
+        with _retriever_lock:
+            if _retriever is None:
+                _retriever = Retriever()
+    return _retriever
+
+def search_and_rerank(query_text, expand=EXPANSION_ENABLED, filters=None):
+    # Its own trace when called directly, a span of the caller's otherwise
+    with trace("retrieve", expand=expand):
+        return get_retriever().search_and_rerank(query_text, expand=expand, filters=filters)
 
 if __name__ == "__main__":
     # Test Query
     test_query = "What is the detailed syllabus for the hardware workshop?"
+    get_retriever().warm_up()
     results = search_and_rerank(test_query)
     
     for i, res in enumerate(results):
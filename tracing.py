@@ -0,0 +1,299 @@
+import contextvars
+import cProfile
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# --- CONFIGURATION ---
+TRACING_ENABLED = os.getenv("RAG_TRACING", "1") != "0" # RAG_TRACING=0 turns every span into a no-op
+TRACE_FILE = None # e.g. "traces.jsonl": append every finished trace as one JSON line
+RECENT_TRACES = 200 # Finished traces kept in memory for the UI / JSON export
+PROFILE_STAGES = set() # Span names to run under cProfile, e.g. {"rerank.predict"}
+PROFILE_DIR = "profiles"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0) # Seconds
+# ---------------------
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+class Trace:
+    """
+    Timings of one request (a question, an indexing run...): the spans it
+    went through, in order, plus free-form attributes such as candidate
+    counts.
+    """
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.id = uuid.uuid4().hex[:12]
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.duration_ms = None
+        self.attrs = dict(attrs)
+        self.spans = []
+
+    def to_dict(self):
+        return {
+            "trace": self.name,
+            "id": self.id,
+            "started_at": self.started_at,
+            "duration_ms": self.duration_ms,
+            "attrs": self.attrs,
+            "spans": list(self.spans),
+        }
+
+class _Metrics:
+    """
+    Process-wide aggregates behind the Prometheus export: a latency
+    histogram per span name and a running total per counter.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {} # name -> [bucket counts..., +Inf count, sum]
+        self.counters = {}
+        self.recent = deque(maxlen=RECENT_TRACES)
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+            histogram[len(LATENCY_BUCKETS)] += 1
+            histogram[-1] += seconds
+
+    def add(self, name, value):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+_metrics = _Metrics()
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+_NOOP = _NoopSpan()
+
+class _Span:
+    __slots__ = ("name", "attrs", "trace", "start", "profiler")
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.trace = _current_trace.get()
+        self.profiler = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        if self.name in PROFILE_STAGES:
+            self.profiler = cProfile.Profile()
+            try:
+                self.profiler.enable()
+            except ValueError: # Another profiler is already running on this thread
+                self.profiler = None
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        if self.profiler is not None:
+            self.profiler.disable()
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            self.profiler.dump_stats(os.path.join(PROFILE_DIR, f"{self.name}-{int(time.time() * 1000)}.prof"))
+        if exc_type is GeneratorExit: # The consumer stopped early (e.g. closed a stream)
+            self.attrs["closed"] = True
+        elif exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        record(self.name, end - self.start, _trace=self.trace, _start=self.start, **self.attrs)
+        return False
+
+def span(name, **attrs):
+    """
+    Times a block as one stage of the current trace:
+
+        with span("retrieve.qdrant", collection=name) as s:
+            ...
+            s.set(hits=len(hits))
+
+    Outside a trace the timing still feeds the per-stage metrics.
+    """
+    if not TRACING_ENABLED:
+        return _NOOP
+    return _Span(name, attrs)
+
+def record(name, seconds, _trace=None, _start=None, **attrs):
+    """
+    Adds a stage timed elsewhere, e.g. in a worker process.
+    """
+    if not TRACING_ENABLED:
+        return
+    _metrics.observe(name, seconds)
+    trace = _trace or _current_trace.get()
+    if trace is not None:
+        start = _start if _start is not None else time.perf_counter() - seconds
+        trace.spans.append({
+            "name": name,
+            "start_ms": round((start - trace.start) * 1000, 3),
+            "duration_ms": round(seconds * 1000, 3),
+            **attrs,
+        })
+
+def count(name, value=1):
+    """
+    Adds to a process-wide counter (exported as rag_items_total).
+    """
+    if TRACING_ENABLED:
+        _metrics.add(name, value)
+
+def annotate(**attrs):
+    """
+    Attaches attributes (candidate counts, cache hits, TTFT...) to the
+    current trace.
+    """
+    if not TRACING_ENABLED:
+        return
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.attrs.update(attrs)
+
+class _TraceScope:
+    def __init__(self, name, attrs):
+        self.trace = Trace(name, attrs)
+
+    def __enter__(self):
+        self.token = _current_trace.set(self.trace)
+        return self.trace
+
+    def __exit__(self, exc_type, exc, tb):
+        trace = self.trace
+        trace.duration_ms = round((time.perf_counter() - trace.start) * 1000, 3)
+        if exc_type is not None:
+            trace.attrs["error"] = exc_type.__name__
+        _current_trace.reset(self.token)
+        _metrics.observe(trace.name, trace.duration_ms / 1000)
+        _finish(trace)
+        return False
+
+def trace(name, **attrs):
+    """
+    Starts a trace for one request. Spans entered while it is active
+    (in this thread, or in work wrapped with bind()) are recorded in it.
+    Inside another trace it is just a span of the outer one.
+    """
+    if not TRACING_ENABLED:
+        return _NOOP
+    if _current_trace.get() is not None:
+        return _Span(name, attrs)
+    return _TraceScope(name, attrs)
+
+def bind(fn):
+    """
+    Wraps fn so it records into the caller's trace when run on another
+    thread (e.g. submitted to a ThreadPoolExecutor).
+    """
+    if not TRACING_ENABLED:
+        return fn
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
+
+def _finish(trace):
+    data = trace.to_dict()
+    with _metrics.lock:
+        _metrics.recent.append(data)
+    stages = ", ".join(f"{s['name']} {s['duration_ms']:.0f}ms" for s in data["spans"])
+    print(f"   🧭 Trace {trace.name} [{trace.id}] {trace.duration_ms:.0f} ms: {stages}")
+    if TRACE_FILE:
+        with _metrics.lock, open(TRACE_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps(data, ensure_ascii=False) + "\n")
+
+def recent_traces(limit=None):
+    """
+    Most recent finished traces as dicts, newest last.
+    """
+    with _metrics.lock:
+        traces = list(_metrics.recent)
+    return traces[-limit:] if limit else traces
+
+def export_json(path=None, limit=None):
+    """
+    Recent traces as a JSON string, also written to path if given.
+    """
+    text = json.dumps(recent_traces(limit), indent=2, ensure_ascii=False)
+    if path:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+    return text
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+def prometheus_text():
+    """
+    Stage latency histograms and counters in the Prometheus text format.
+    """
+    with _metrics.lock:
+        histograms = {name: list(h) for name, h in _metrics.histograms.items()}
+        counters = dict(_metrics.counters)
+
+    lines = [
+        "# HELP rag_stage_duration_seconds Time spent per RAG pipeline stage.",
+        "# TYPE rag_stage_duration_seconds histogram",
+    ]
+    for name, histogram in sorted(histograms.items()):
+        stage = _label(name)
+        for bound, n in zip(LATENCY_BUCKETS, histogram):
+            lines.append(f'rag_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {n}')
+        total = histogram[len(LATENCY_BUCKETS)]
+        lines.append(f'rag_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {total}')
+        lines.append(f'rag_stage_duration_seconds_sum{{stage="{stage}"}} {histogram[-1]:.6f}')
+        lines.append(f'rag_stage_duration_seconds_count{{stage="{stage}"}} {total}')
+
+    lines += [
+        "# HELP rag_items_total Items processed per stage (candidates, pairs, chunks...).",
+        "# TYPE rag_items_total counter",
+    ]
+    for name, value in sorted(counters.items()):
+        lines.append(f'rag_items_total{{name="{_label(name)}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.startswith("/metrics"):
+            body, content_type = prometheus_text(), "text/plain; version=0.0.4"
+        elif self.path.startswith("/traces"):
+            body, content_type = export_json(), "application/json"
+        else:
+            self.send_error(404)
+            return
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+def start_metrics_server(port, host="127.0.0.1"):
+    """
+    Serves /metrics (Prometheus) and /traces (JSON) from a daemon thread.
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print(f"📈 Metrics on http://{host}:{server.server_address[1]}/metrics, traces on /traces")
+    return server